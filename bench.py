@@ -0,0 +1,370 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+#
+# Benchmarks for wsym on synthetic inputs:
+#
+#  - ELF files built with the ELFFactory structures, for every class
+#    and endianness, with and without section headers and with any
+#    number of PT_LOAD segments.
+#  - flat, nm and IDA maps with as many symbols as asked for.
+#
+# Every measure runs in its own forked process so peak memory is
+# its own. Results are printed and saved as JSON, give a previous
+# result file with --baseline to see what changed.
+#
+
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import tempfile
+import multiprocessing
+
+from ctypes import sizeof
+
+import elf
+import wsym
+
+CLASSES = {"32": elf.ELFCLASS32, "64": elf.ELFCLASS64}
+ENCODINGS = {"LSB": elf.ELFDATA2LSB, "MSB": elf.ELFDATA2MSB}
+
+PAGE = 0x1000
+
+
+def make_elf(ei_class, ei_data, nloads=2, shdrs=True, segsize=1 << 20):
+
+    # Returns the image of an executable with nloads segments of segsize
+    # bytes each, and one section per segment if shdrs. Only what wsym
+    # looks at is filled in.
+
+    factory = elf.ELFFactory(ei_class, ei_data)
+    ehdr_t, phdr_t, shdr_t = (
+        factory.elf_ehdr(), factory.elf_phdr(), factory.elf_shdr())
+
+    ehdr = ehdr_t()
+    ehdr.e_ident[:8] = b"\x7fELF" + bytes([ei_class, ei_data, elf.EV_CURRENT, 0])
+    ehdr.e_type = elf.ET_EXEC
+    ehdr.e_version = elf.EV_CURRENT
+    ehdr.e_ehsize = sizeof(ehdr_t)
+    ehdr.e_phoff = sizeof(ehdr_t)
+    ehdr.e_phentsize = sizeof(phdr_t)
+    ehdr.e_phnum = nloads
+
+    offset = -(-(ehdr.e_phoff + nloads * sizeof(phdr_t)) // PAGE) * PAGE
+
+    phdrs = (phdr_t * nloads)()
+    for i, phdr in enumerate(phdrs):
+        phdr.p_type = elf.PT_LOAD
+        phdr.p_flags = elf.PF_R | (elf.PF_X if i == 0 else elf.PF_W)
+        phdr.p_offset = offset + i * segsize
+        phdr.p_vaddr = phdr.p_paddr = 0x08000000 + i * (segsize + PAGE)
+        phdr.p_filesz = phdr.p_memsz = segsize
+        phdr.p_align = PAGE
+
+    ehdr.e_entry = phdrs[0].p_vaddr
+
+    image = bytearray(offset + nloads * segsize)
+
+    if shdrs:
+        names = [b""] + [b".seg%d" % i for i in range(nloads)] + [b".shstrtab"]
+        shstrtab = b"\x00".join(names) + b"\x00"
+
+        table = (shdr_t * len(names))()
+        for i, phdr in enumerate(phdrs, 1):
+            table[i].sh_type = elf.SHT_PROGBITS
+            table[i].sh_flags = elf.SHF_ALLOC | (
+                elf.SHF_EXECINSTR if phdr.p_flags & elf.PF_X else elf.SHF_WRITE)
+            table[i].sh_addr = phdr.p_vaddr
+            table[i].sh_offset = phdr.p_offset
+            table[i].sh_size = phdr.p_filesz
+            table[i].sh_addralign = 1
+
+        table[-1].sh_type = elf.SHT_STRTAB
+        table[-1].sh_offset = len(image)
+        table[-1].sh_size = len(shstrtab)
+        table[-1].sh_addralign = 1
+        for shdr, name in zip(table, names):
+            shdr.sh_name = shstrtab.index(name + b"\x00") if name else 0
+
+        image += shstrtab
+        ehdr.e_shoff = len(image)
+        ehdr.e_shentsize = sizeof(shdr_t)
+        ehdr.e_shnum = len(names)
+        ehdr.e_shstrndx = len(names) - 1
+        image += bytes(table)
+
+    image[0:sizeof(ehdr)] = bytes(ehdr)
+    image[ehdr.e_phoff:ehdr.e_phoff + sizeof(phdrs)] = bytes(phdrs)
+
+    return bytes(image)
+
+
+def make_symbols(image, count, seed=0):
+
+    # count (segment, offset, name, size) spread over the PT_LOADs,
+    # segments are numbered from 0. Names look like what IDA and
+    # C++ compilers give, lengths vary and some share suffixes.
+
+    elff = elf.ELFFile(bytearray(image))
+    loads = [phdr for phdr in elff.phdrs if phdr.p_type == elf.PT_LOAD]
+    rnd = random.Random(seed)
+
+    words = ["alloc", "buffer", "check", "decode", "entry", "frame", "get",
+             "handler", "init", "lock", "map", "node", "parse", "queue",
+             "read", "set", "table", "update", "write"]
+
+    symbols = []
+    per = -(-count // len(loads))
+    for i in range(count):
+        segment = i % len(loads)
+        stride = max(loads[segment].p_memsz // per, 1)
+        offset = (i // len(loads)) * stride % loads[segment].p_memsz
+        kind = rnd.random()
+        if kind < 0.5:
+            name = "sub_%X" % (loads[segment].p_vaddr + offset)
+        elif kind < 0.8:
+            name = "%s_%s_%d" % (rnd.choice(words), rnd.choice(words), i)
+        else:
+            name = "_ZN%d%s%dEv_%d" % (i % 7 + 3, rnd.choice(words), i % 5,
+                                       i)
+        symbols.append((segment, offset, name, rnd.randrange(0, 512, 4)))
+
+    return loads, symbols
+
+
+def write_map(path, fmt, loads, symbols):
+
+    with open(path, "w") as f:
+
+        if fmt == "flat":
+            for segment, offset, name, size in symbols:
+                f.write("%x %s %x\n" % (loads[segment].p_vaddr + offset,
+                                        name, size))
+
+        elif fmt == "nm":
+            for segment, offset, name, size in symbols:
+                f.write("%016x T %s\n" % (loads[segment].p_vaddr + offset,
+                                          name))
+
+        elif fmt == "ida":
+            # Segment relative, for a target without sections: IDAParser
+            # maps segment number n to phdrs[n + 1], symbols of the first
+            # segment can't be written.
+            shift = -1
+            f.write("\n Start         Length     Name                   Class\n")
+            for segment, phdr in enumerate(loads):
+                if segment + shift >= 0:
+                    f.write(" %04X:%08X %08XH .seg%-19d CODE\n" % (
+                            segment + shift, 0, phdr.p_memsz, segment))
+            f.write("\n\n  Address         Publics by Value\n\n")
+            for segment, offset, name, _ in symbols:
+                if segment + shift >= 0:
+                    f.write(" %04X:%08X       %s\n" % (
+                            segment + shift, offset, name))
+            f.write("\nProgram entry point at %04X:00000000\n" % max(shift, 0))
+
+        else:
+            raise ValueError("Unknown map format %r" % fmt)
+
+
+def measure(func, *args):
+
+    # Run func(*args) in a forked child, returns what it returns plus
+    # elapsed wall and CPU time and the peak RSS of the child.
+
+    def child(conn):
+        try:
+            # Reset the peak RSS we inherited (Linux only).
+            with open("/proc/self/clear_refs", "w") as f:
+                f.write("5")
+        except OSError:
+            pass
+
+        start, cpu = time.perf_counter(), time.process_time()
+        result = func(*args)
+        elapsed, cpu = time.perf_counter() - start, time.process_time() - cpu
+
+        peak = None
+        try:
+            with open("/proc/self/status") as f:
+                for line in f:
+                    if line.startswith("VmHWM:"):
+                        peak = int(line.split()[1]) << 10
+        except OSError:
+            pass
+        if peak is None:
+            import resource
+            peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss << 10
+
+        conn.send((result, elapsed, cpu, peak))
+        conn.close()
+
+    ctx = multiprocessing.get_context("fork")
+    parent, conn = ctx.Pipe(duplex=False)
+    process = ctx.Process(target=child, args=(conn,))
+    process.start()
+    conn.close()
+    try:
+        result = parent.recv()
+    except EOFError:
+        raise RuntimeError("benchmark process died")
+    finally:
+        process.join()
+
+    return result
+
+
+def run_parser(parser_t, map_path, elf_path, jobs):
+    parser = parser_t(map_path)
+    target = elf.ELFFile(elf_path)
+    n = 0
+    for n, _ in enumerate(parser.get_symbols(target, jobs=jobs), 1):
+        pass
+    return n, 0
+
+
+def run_add_symbols(elf_path, map_path):
+    elff = elf.ELFFile(elf_path)
+    symbols = list(wsym.FlatParser(map_path).get_symbols(elff))
+    # Parsing isn't what we measure here, only time the rest.
+    start, cpu = time.perf_counter(), time.process_time()
+    newelff = wsym.add_symbols(elff, symbols)
+    return (len(symbols), len(newelff.data),
+            time.perf_counter() - start, time.process_time() - cpu)
+
+
+def run_write_symbols(elf_path, map_path, out_path):
+    with open(elf_path, "rb") as source, open(out_path, "wb") as output:
+        elff = elf.ELFFile(elf.map_file(source))
+        symbols = list(wsym.FlatParser(map_path).get_symbols(elff))
+        start, cpu = time.perf_counter(), time.process_time()
+        tables = wsym.write_symbols(elff, symbols, output, source=source)
+        output.flush()
+    return (len(symbols), tables.base + tables.size,
+            time.perf_counter() - start, time.process_time() - cpu)
+
+
+PARSERS = {"flat": wsym.FlatParser, "nm": wsym.NMParser, "ida": wsym.IDAParser}
+
+
+def bench(args, workdir):
+
+    results = []
+
+    def record(kind, name, count, size, elapsed, cpu, peak):
+        result = {
+            "kind": kind, "name": name, "symbols": count,
+            "wall": elapsed, "cpu": cpu, "rate": count / elapsed if elapsed else 0,
+            "peak_memory": peak, "output_size": size,
+        }
+        results.append(result)
+        print("%-16s %-28s %9d %8.3fs %8.3fs %12.0f/s %8.1f MB %10d" % (
+                kind, name, count, elapsed, cpu, result["rate"],
+                peak / 1e6, size))
+        sys.stdout.flush()
+
+    print("%-16s %-28s %9s %9s %9s %14s %11s %10s" % (
+            "bench", "input", "symbols", "wall", "cpu", "rate", "peak", "output"))
+
+    for cls in args.classes:
+        for enc in args.encodings:
+            for nloads in args.loads:
+                for shdrs in (True, False):
+                    variant = "ELF%s%s-%dload%s" % (
+                        cls, enc, nloads, "" if shdrs else "-noshdr")
+                    image = make_elf(CLASSES[cls], ENCODINGS[enc], nloads,
+                                     shdrs, args.segment_size)
+                    elf_path = os.path.join(workdir, variant)
+                    with open(elf_path, "wb") as f:
+                        f.write(image)
+
+                    for count in args.sizes:
+                        loads, symbols = make_symbols(image, count)
+                        name = "%s/%d" % (variant, count)
+
+                        # The parsers once, on the first variant without
+                        # sections (see write_map).
+                        if (not shdrs and cls == args.classes[0]
+                            and enc == args.encodings[0]
+                            and nloads == args.loads[0]):
+                            for fmt in args.formats:
+                                map_path = os.path.join(workdir, "%s.%s" % (name.replace("/", "."), fmt))
+                                write_map(map_path, fmt, loads, symbols)
+                                (n, size), elapsed, cpu, peak = measure(
+                                    run_parser, PARSERS[fmt], map_path, elf_path, args.jobs)
+                                record("parse-" + fmt, name, n, size, elapsed, cpu, peak)
+                                os.unlink(map_path)
+
+                        map_path = os.path.join(workdir, "symbols.flat")
+                        write_map(map_path, "flat", loads, symbols)
+
+                        (n, size, elapsed, cpu), _, _, peak = measure(
+                            run_add_symbols, elf_path, map_path)
+                        record("add_symbols", name, n, size, elapsed, cpu, peak)
+
+                        out_path = os.path.join(workdir, "out")
+                        (n, size, elapsed, cpu), _, _, peak = measure(
+                            run_write_symbols, elf_path, map_path, out_path)
+                        record("write_symbols", name, n, size, elapsed, cpu, peak)
+                        os.unlink(out_path)
+
+                    os.unlink(elf_path)
+
+    return results
+
+
+def compare(results, baseline):
+
+    old = {(r["kind"], r["name"]): r for r in baseline}
+
+    print()
+    print("%-16s %-28s %10s %10s" % ("bench", "input", "time", "memory"))
+    for result in results:
+        before = old.get((result["kind"], result["name"]))
+        if before is None or not before["wall"] or not before["peak_memory"]:
+            continue
+        print("%-16s %-28s %+9.1f%% %+9.1f%%" % (
+                result["kind"], result["name"],
+                (result["wall"] / before["wall"] - 1) * 100,
+                (result["peak_memory"] / before["peak_memory"] - 1) * 100))
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-s", "--sizes", type=int, nargs="+",
+                        default=[1000, 10000, 100000, 1000000],
+                        help="numbers of symbols. (default: %(default)s)")
+    parser.add_argument("-l", "--loads", type=int, nargs="+", default=[2, 8],
+                        help="numbers of PT_LOAD. (default: %(default)s)")
+    parser.add_argument("--classes", nargs="+", choices=sorted(CLASSES),
+                        default=sorted(CLASSES))
+    parser.add_argument("--encodings", nargs="+", choices=sorted(ENCODINGS),
+                        default=sorted(ENCODINGS))
+    parser.add_argument("--formats", nargs="+", choices=sorted(PARSERS),
+                        default=sorted(PARSERS))
+    parser.add_argument("--segment-size", type=lambda x: int(x, 0), default=1 << 20,
+                        help="size of each segment. (default: %(default)s)")
+    parser.add_argument("-j", "--jobs", type=int, default=1,
+                        help="parser worker processes. (default: %(default)s)")
+    parser.add_argument("-o", "--output", default="bench_output.txt",
+                        help="where to save the results. (default: %(default)s)")
+    parser.add_argument("-b", "--baseline",
+                        help="results of a previous run to compare with.")
+    args = parser.parse_args()
+
+    if any(n < 2 for n in args.loads):
+        parser.error("IDA maps without sections need at least 2 PT_LOAD.")
+
+    with tempfile.TemporaryDirectory(prefix="wsym-bench-") as workdir:
+        results = bench(args, workdir)
+
+    with open(args.output, "w") as f:
+        json.dump(results, f, indent=1)
+
+    if args.baseline is not None:
+        with open(args.baseline) as f:
+            compare(results, json.load(f))
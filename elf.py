@@ -1,9 +1,13 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
+import os
+import mmap
 import ctypes
+import struct
 from ctypes import *
-from functools import wraps
+from bisect import bisect_right
+from functools import wraps, cached_property
 
 class PrintableStructureMixIn(object):
     def show(self):
@@ -30,13 +34,64 @@ class LittleEndianStructure(ctypes.LittleEndianStructure,
                             CopyableStructureMixIn):
     pass
 
+class StructureCodec(object):
+
+    # A ctypes structure along with a struct.Struct of the exact same
+    # layout (ELF structures have no padding so standard sizes just
+    # work) for packing and unpacking whole arrays of them at once.
+
+    def __init__(self, ctype, byteorder):
+        self.ctype = ctype
+        self.fields = [name for name, _ in ctype._fields_]
+
+        fmt = byteorder
+        for _, field_type in ctype._fields_:
+            if issubclass(field_type, ctypes.Array):
+                fmt += "%ds" % sizeof(field_type)
+            else:
+                fmt += {1: "B", 2: "H", 4: "I", 8: "Q"}[sizeof(field_type)]
+
+        self.struct = struct.Struct(fmt)
+        self.size = self.struct.size
+
+    def unpack_from(self, buffer, offset=0):
+        return self.struct.unpack_from(buffer, offset)
+
+    def iter_unpack(self, buffer, offset=0, count=None):
+        view = memoryview(buffer)[offset:]
+        if count is None:
+            count = len(view) // self.size
+        return self.struct.iter_unpack(view[:count * self.size])
+
+    def pack_array(self, count, **columns):
+        # Pack columns of field values into one contiguous array
+        # of structures.
+        rows = zip(*(columns[name] for name in self.fields))
+
+        array = bytearray(count * self.size)
+        pack_into = self.struct.pack_into
+        for offset, values in zip(range(0, len(array), self.size), rows):
+            pack_into(array, offset, *values)
+
+        return array
+
+_codecs = {}
+
 def build_structure(f):
+    # Structures are built once per (class, endianness) and cached,
+    # the codec is reachable from the ctypes class as .codec.
     @wraps(f)
     def wrapper(self, *args, **kwargs):
-        name = ''.join(w[0].upper() + w[1:] for w in f.__name__.split('_'))
-        return type("%s%d%s" % (name, self.wordsize, self.endianess),
-                    (self.structure, ),
-                    {"_fields_": f(self, *args, **kwargs)})
+        key = (f.__name__, self.ei_class, self.ei_data) + args
+        codec = _codecs.get(key)
+        if codec is None:
+            name = ''.join(w[0].upper() + w[1:] for w in f.__name__.split('_'))
+            ctype = type("%s%d%s" % (name, self.wordsize, self.endianess),
+                         (self.structure, ),
+                         {"_fields_": f(self, *args, **kwargs)})
+            codec = _codecs[key] = ctype.codec = StructureCodec(
+                ctype, "<" if self.ei_data == ELFDATA2LSB else ">")
+        return codec.ctype
     return wrapper
 
 def select_class(f):
@@ -185,36 +240,247 @@ class ELFFactory(object):
             }
 
 
+def map_file(f):
+    # Private (copy on write) mapping: pages are only read when
+    # touched and ctypes can still build views on top of it.
+    return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY)
+
 class ELFFile(ELFFactory):
 
+    # data can be a bytearray, anything supporting the buffer
+    # protocol (bytes, a read-only mmap...) or a path to map.
+    # Headers are decoded on first access, as views on data
+    # when it is writable, as copies of the header bytes if not.
+
     def __init__(self, data):
 
+        if isinstance(data, (str, os.PathLike)):
+            with open(data, "rb") as f:
+                data = map_file(f)
+
         if data[:4] != b"\x7fELF":
             raise ValueError("Data is not an elf image.")
 
         self.data = data
+        self._shstrs = {} # map offset -> name, filled by shstr()
 
         ei_class, ei_data = data[4:6]
         super().__init__(ei_class, ei_data)
 
-        self.ehdr = self.elf_ehdr().from_buffer(self.data)
+    def view(self, structure, offset=0):
+        try:
+            return structure.from_buffer(self.data, offset)
+        except TypeError:
+            return structure.from_buffer_copy(self.data, offset)
+
+    @cached_property
+    def ehdr(self):
+        return self.view(self.elf_ehdr())
+
+    # With extended numbering the real number of sections, index of
+    # the shstrtab and number of segments are kept in section 0.
+
+    def first_shdr(self):
+        if not self.ehdr.e_shoff:
+            return None
+        return self.view(self.elf_shdr(), self.ehdr.e_shoff)
+
+    @cached_property
+    def phnum(self):
+        if self.ehdr.e_phnum == PN_XNUM and self.first_shdr() is not None:
+            return self.first_shdr().sh_info
+        return self.ehdr.e_phnum
+
+    @cached_property
+    def shnum(self):
+        if self.ehdr.e_shnum == 0 and self.first_shdr() is not None:
+            return self.first_shdr().sh_size
+        return self.ehdr.e_shnum
+
+    @cached_property
+    def shstrndx(self):
+        if self.ehdr.e_shstrndx == SHN_XINDEX and self.first_shdr() is not None:
+            return self.first_shdr().sh_link
+        return self.ehdr.e_shstrndx
 
-        self.phdrs = (self.elf_phdr() * self.ehdr.e_phnum).from_buffer(
-            self.data, self.ehdr.e_phoff)
+    @cached_property
+    def phdrs(self):
+        return self.view(self.elf_phdr() * self.phnum,
+                         self.ehdr.e_phoff)
 
-        self.shdrs = (self.elf_shdr() * self.ehdr.e_shnum).from_buffer(
-            self.data, self.ehdr.e_shoff)
+    @cached_property
+    def shdrs(self):
+        return self.view(self.elf_shdr() * self.shnum,
+                         self.ehdr.e_shoff)
 
-    def shstr(self, shndx):
+    @cached_property
+    def shstrtab(self):
+        if not 0 < self.shstrndx < len(self.shdrs):
+            return b""
+        strtab = self.shdrs[self.shstrndx]
+        return bytes(self.data[strtab.sh_offset:strtab.sh_offset + strtab.sh_size])
 
-        strtab = self.shdrs[self.ehdr.e_shstrndx]
-        offset = strtab.sh_offset + shndx
-        end = self.data.find(b"\x00", offset)
+    def shstr(self, offset):
 
+        # The NUL terminated name at offset in the shstrtab.
+
+        try:
+            return self._shstrs[offset]
+        except KeyError:
+            pass
+
+        end = self.shstrtab.find(b"\x00", offset)
         if end < 0:
-            raise KeyError(shndx)
+            raise KeyError(offset)
+
+        name = self._shstrs[offset] = self.shstrtab[offset:end+1]
+        return name
+
+    # Section names are decoded once, unreadable ones are None.
+    # With duplicate names, section_index has the first one.
+
+    @cached_property
+    def section_names(self):
+        names = []
+        for shdr in self.shdrs:
+            try:
+                names.append(self.shstr(shdr.sh_name)[:-1])
+            except KeyError:
+                names.append(None)
+        return names
+
+    @cached_property
+    def section_index(self):
+        index = {}
+        for shndx, name in enumerate(self.section_names):
+            if name is not None:
+                index.setdefault(name, shndx)
+        return index
+
+    def section_name(self, shndx):
+        return self.section_names[shndx]
+
+    def section_by_name(self, name):
+        return self.shdrs[self.section_index[name]]
+
+class StrtabBuilder(object):
+
+    # Builds a string table in linear time, identical strings are
+    # only stored once. With tail_merge, strings that are a suffix
+    # of another one point inside it (like ld does for .strtab),
+    # offsets are then only known once build() has been called.
+    # With a stream, the table is written to it as it grows and
+    # only the last window strings are remembered for dedup.
+
+    def __init__(self, tail_merge=False, stream=None, window=None):
+        if tail_merge and stream is not None:
+            raise ValueError("Can't tail merge a streamed string table.")
+
+        self.tail_merge = tail_merge
+        self.stream = stream
+        self.window = window
+        self.flushed = 0
+        self.offsets = {b"": 0}
+        self.data = bytearray(b"\x00")
+
+    def add(self, string):
+        offset = self.offsets.get(string)
+        if offset is None:
+            if self.tail_merge:
+                self.offsets[string] = None
+                return None
+            if self.window is not None and len(self.offsets) > self.window:
+                self.offsets = {b"": 0}
+            offset = self.offsets[string] = self.flushed + len(self.data)
+            self.data += string
+            self.data.append(0)
+            if self.stream is not None and len(self.data) >= 1 << 20:
+                self.flush()
+        return offset
+
+    def flush(self):
+        self.stream.write(self.data)
+        self.flushed += len(self.data)
+        self.data = bytearray()
+
+    def build(self):
+        if self.stream is not None:
+            self.flush()
+            return self.stream
+        if not self.tail_merge:
+            return self.data
+
+        # Sorting on the reversed strings puts every string
+        # right after the ones it is a suffix of.
+        data = bytearray(b"\x00")
+        offsets = self.offsets
+        last = b""
+        for string in sorted(offsets, key=lambda s: s[::-1], reverse=True):
+            if last.endswith(string):
+                offsets[string] = offsets[last] + len(last) - len(string)
+            else:
+                offsets[string] = len(data)
+                data += string
+                data.append(0)
+                last = string
+
+        self.data = data
+        return self.data
+
+    def __getitem__(self, string):
+        return self.offsets[string]
+
+    def __len__(self):
+        return self.flushed + len(self.data)
+
+
+class SectionIndex(object):
+
+    # Sorted interval index answering "smallest section containing addr".
+    # Section boundaries split the address space into elementary ranges,
+    # each range is labeled once with the smallest section covering it
+    # and lookups are a bisect over the range starts.
+    # Only SHF_ALLOC sections are indexed, on ties the first one wins.
+    # .tbss takes no room in memory and overlaps whatever follows it
+    # (.init_array...), it is left out like binutils does.
+
+    def __init__(self, shdrs):
+
+        sections = []
+        for shndx, shdr in enumerate(shdrs):
+            if not shdr.sh_flags & SHF_ALLOC or not shdr.sh_size:
+                continue
+            if shdr.sh_type == SHT_NOBITS and shdr.sh_flags & SHF_TLS:
+                continue
+            sections.append((shdr.sh_addr, shdr.sh_addr + shdr.sh_size, shndx))
+
+        bounds = set()
+        for start, end, _ in sections:
+            bounds.add(start)
+            bounds.add(end)
+
+        self.starts = sorted(bounds)
+        self.shndxs = [None] * len(self.starts)
+
+        position = {addr: i for i, addr in enumerate(self.starts)}
+
+        # Paint biggest first so smaller sections overwrite them.
+        sections.sort(key=lambda s: (s[1] - s[0], s[2]), reverse=True)
+        for start, end, shndx in sections:
+            for i in range(position[start], position[end]):
+                self.shndxs[i] = shndx
+
+    def lookup(self, addr):
+        i = bisect_right(self.starts, addr) - 1
+        if i < 0:
+            return None
+        return self.shndxs[i]
+
+    def lookup_many(self, addrs):
+        starts, shndxs = self.starts, self.shndxs
+        return [shndxs[i] if i >= 0 else None
+                for i in (bisect_right(starts, addr) - 1 for addr in addrs)]
 
-        return self.data[offset:end+1]
 
 EI_NIDENT = (16)
 EI_MAG0 = 0
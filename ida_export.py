@@ -0,0 +1,74 @@
+#
+# IDAPython script exporting the names of the current database in
+# the binary format wsym reads with -x/--bin:
+#
+#   File > Script file... > ida_export.py
+#   ./wsym.py -x binary.wsym binary binary.sym
+#
+# Unlike .map files addresses are already virtual addresses and
+# functions come with their size, wsym has nothing to guess.
+#
+# The layout must stay in sync with wsym.BinaryParser, this script
+# runs inside IDA and can't import it.
+#
+
+import struct
+
+import idautils
+import ida_bytes
+import ida_funcs
+import ida_kernwin
+import ida_nalt
+
+HEADER = struct.Struct("<8sQQ")
+RECORD = struct.Struct("<QQIHBB")
+MAGIC = b"WSYMBIN1"
+
+STT_OBJECT = 1
+STT_FUNC = 2
+
+
+def symbols():
+
+    # Every function (even sub_XXX ones) and every other named item,
+    # as (addr, size, name, type).
+
+    seen = set()
+
+    for ea in idautils.Functions():
+        func = ida_funcs.get_func(ea)
+        seen.add(ea)
+        yield ea, func.end_ea - func.start_ea, ida_funcs.get_func_name(ea), STT_FUNC
+
+    for ea, name in idautils.Names():
+        if ea in seen:
+            continue
+        seen.add(ea)
+        yield ea, ida_bytes.get_item_size(ea), name, STT_OBJECT
+
+
+def export(path):
+
+    records, names = [], bytearray()
+
+    for addr, size, name, kind in symbols():
+        name = name.encode("utf8")
+        if not name or len(name) > 0xffff:
+            continue
+        records.append(RECORD.pack(addr, size, len(names), len(name), kind, 0))
+        names += name
+
+    with open(path, "wb") as f:
+        f.write(HEADER.pack(MAGIC, len(records), len(names)))
+        f.write(b"".join(records))
+        f.write(names)
+
+    return len(records)
+
+
+if __name__ == "__main__":
+
+    path = ida_kernwin.ask_file(True, ida_nalt.get_root_filename() + ".wsym",
+                                "Export symbols for wsym")
+    if path:
+        print("wsym: %d symbols exported to %s." % (export(path), path))
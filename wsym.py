@@ -1,14 +1,192 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
+import io
+import os
+import sys
+import mmap
+import time
+import gzip
+import json
+import lzma
+import shlex
+import select
+import struct
 import ctypes
+import socket
+import hashlib
+import resource
+import shutil
 import argparse
+import tempfile
+import weakref
+import socketserver
+import multiprocessing
+
+from array import array
+from collections import OrderedDict
+from contextlib import contextmanager, redirect_stderr
+from itertools import chain, compress, islice, repeat
 
 from ctypes import sizeof, pointer
 
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
 import elf
 
-def add_symbols(elff, symbols):
+# Symbols are resolved and packed this many at a time.
+BATCH_SIZE = 1 << 16
+
+# Our tables stay in memory up to this size, then go to temporary
+# files. Only this many names are remembered for deduplication.
+SPOOL_SIZE = 64 << 20
+DEDUP_WINDOW = 1 << 18
+
+
+class Stats(object):
+
+    # Wall and CPU time spent in each phase plus a few counters.
+    # Phases nest, time is charged to the innermost one only.
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.times = {} # phase -> [wall, cpu]
+        self.counters = {}
+        self.stack = []
+        self.mark = time.perf_counter(), time.process_time()
+
+    def charge(self):
+        now = time.perf_counter(), time.process_time()
+        if self.stack:
+            times = self.times.setdefault(self.stack[-1], [0.0, 0.0])
+            times[0] += now[0] - self.mark[0]
+            times[1] += now[1] - self.mark[1]
+        self.mark = now
+
+    @contextmanager
+    def phase(self, name):
+        self.charge()
+        self.stack.append(name)
+        try:
+            yield
+        finally:
+            self.charge()
+            self.stack.pop()
+
+    def count(self, name, n=1):
+        self.counters[name] = self.counters.get(name, 0) + n
+
+    def report(self):
+        # Peak RSS is in kB on Linux, workers are counted separately.
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss << 10
+        children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss << 10
+        return {
+            "phases": {name: {"wall": wall, "cpu": cpu}
+                       for name, (wall, cpu) in self.times.items()},
+            "counters": dict(self.counters),
+            "peak_memory": peak,
+            "peak_memory_workers": children,
+        }
+
+    def table(self):
+        report = self.report()
+        lines = ["%-10s %10s %10s" % ("phase", "wall", "cpu")]
+        for name, times in report["phases"].items():
+            lines.append("%-10s %9.3fs %9.3fs" % (name, times["wall"], times["cpu"]))
+        lines.append("%-10s %9.3fs %9.3fs" % (
+                "total", sum(t["wall"] for t in report["phases"].values()),
+                sum(t["cpu"] for t in report["phases"].values())))
+        for name, value in report["counters"].items():
+            lines.append("%-22s %d" % (name, value))
+        lines.append("%-22s %.1f MB" % ("peak memory", report["peak_memory"] / 1e6))
+        if report["peak_memory_workers"]:
+            lines.append("%-22s %.1f MB" % (
+                    "peak memory (workers)", report["peak_memory_workers"] / 1e6))
+        return "\n".join(lines)
+
+stats = Stats()
+
+def own_tables(elff):
+
+    # If we already ran on this file, returns the headers of the
+    # tables we added in file order: .wsymtab_shndx (if there was
+    # one), .wsymtab, .strtab and .shstrtab. None otherwise.
+
+    shdrs = elff.shdrs
+    if len(shdrs) < 4:
+        return None
+
+    names = elff.section_names
+
+    nbg = sum(phdr.p_type == elf.PT_LOAD for phdr in elff.phdrs)
+
+    if (names[-3:] != [b".wsymtab", b".strtab", b".shstrtab"]
+        or elff.shstrndx != len(shdrs) - 1
+        or not all((name or b"").startswith(b"GHOST") for name in names[1:nbg+1])):
+        return None
+
+    symtab, strtab, shstrtab = shdrs[-3:]
+    end = elff.ehdr.e_shoff + len(shdrs) * elff.ehdr.e_shentsize
+
+    if (strtab.sh_offset != symtab.sh_offset + symtab.sh_size
+        or shstrtab.sh_offset != strtab.sh_offset + strtab.sh_size
+        or elff.ehdr.e_shoff != shstrtab.sh_offset + shstrtab.sh_size
+        or end != len(elff.data)):
+        return None
+
+    if names[-4] == b".wsymtab_shndx":
+        shndxtab = shdrs[-4]
+        if shndxtab.sh_offset + shndxtab.sh_size != symtab.sh_offset:
+            return None
+        return [shndxtab, symtab, strtab, shstrtab]
+
+    return [symtab, strtab, shstrtab]
+
+
+def original_sections(elff):
+
+    # Find what the original file looked like, returns the size of
+    # the original data and its sections as (shdr, name) pairs.
+    # If we already ran on this file this strips our previous
+    # ghosts, tables and section header table.
+
+    base, sections = len(elff.data), []
+
+    for shdr, name in zip(elff.shdrs, elff.section_names):
+        sections.append((shdr.copy(), name if name is not None else b"corrupt"))
+
+    tables = own_tables(elff)
+    if tables is None:
+        return base, sections
+
+    # This is our own layout, undo what build_tables did.
+
+    nbg = sum(phdr.p_type == elf.PT_LOAD for phdr in elff.phdrs)
+    shoffset = nbg + 1
+    sections = sections[shoffset:-len(tables)]
+
+    for shdr, _ in sections:
+        shdr.sh_link -= shoffset
+        if shdr.sh_flags & elf.SHF_INFO_LINK:
+            shdr.sh_info -= shoffset
+
+    return tables[0].sh_offset, sections
+
+
+# The section index of the layout build_tables makes for each ELFFile
+# (with and without the original sections), it only depends on the
+# headers and --watch, the gdb loader and the service rebuild from
+# the same ELFFile again and again.
+section_indexes = weakref.WeakKeyDictionary() # elff -> {symbols_only: index}
+
+
+def build_tables(elff, symbols, tail_merge=False, spool=None,
+                 symbols_only=False):
 
     #
     # THE PLAN:
@@ -19,16 +197,29 @@ def add_symbols(elff, symbols):
     #    at the end of the file.
     #  - Hijack e_shoff and point it to our sections.
     #
+    # This only builds what goes after the original data,
+    # see add_symbols and write_symbols to get a new file.
 
-    shstrtab = b""
+    if symbols_only:
+        # Nothing of the original is kept but the headers,
+        # see write_companion.
+        base = sizeof(elff.ehdr) + sizeof(elff.phdrs)
+        originals = []
+    else:
+        base, originals = original_sections(elff)
+
+    # Section names are only resolved to offsets once the
+    # shstrtab is built, tail merging needs to see them all.
+    shstrtab = elf.StrtabBuilder(tail_merge=tail_merge)
 
     shdr_t = elff.elf_shdr()
     shdrs = []
+    shnames = []
 
     # Add null section.
     nullhdr = shdr_t()
-    shstrtab += b"\x00"
     shdrs.append(nullhdr)
+    shnames.append(b"")
 
 
     # Build a ghost section for each segment.
@@ -40,9 +231,6 @@ def add_symbols(elff, symbols):
             continue
 
         shdr = shdr_t()
-        shdr.sh_name = len(shstrtab)
-        shstrtab += bytes("GHOST%d_%.*x\x00" % (
-                nbg, elff.wordsize // 4, phdr.p_vaddr), "utf8")
         shdr.sh_type = elf.SHT_NOBITS
         shdr.sh_flags = elf.SHF_ALLOC
         if phdr.p_flags & elf.PF_X:
@@ -57,6 +245,8 @@ def add_symbols(elff, symbols):
         shdr.sh_addralign = 1 # Probably fine.
         shdr.sh_entsize = 0
         shdrs.append(shdr)
+        shnames.append(bytes("GHOST%d_%.*x" % (
+                nbg, elff.wordsize // 4, phdr.p_vaddr), "utf8"))
         nbg += 1
 
 
@@ -65,17 +255,7 @@ def add_symbols(elff, symbols):
     # rewrite the original symtab.
 
     shoffset = len(shdrs)
-    for shdr in elff.shdrs:
-
-        shdr = shdr.copy()
-
-        try:
-            name = bytes(elff.shstr(shdr.sh_name))
-        except KeyError:
-            name = b"corrupt\x00"
-
-        shdr.sh_name = len(shstrtab)
-        shstrtab += name
+    for shdr, name in originals:
 
         shdr.sh_link += shoffset
 
@@ -83,65 +263,154 @@ def add_symbols(elff, symbols):
             shdr.sh_info += shoffset
 
         shdrs.append(shdr)
-
-    symstrtab = b""
+        shnames.append(name)
 
 
     # Collect symbols:
+    # Symbols are consumed in batches, each batch is resolved to
+    # sections at once and packed as one array. When spooling, the
+    # symtab and strtab go to temporary files that stay in memory
+    # until they get bigger than spool, memory is then bounded no
+    # matter how many symbols we are given (unless tail merging).
 
     sym_t = elff.elf_sym()
-    symtab = []
 
-    nullsym = sym_t()
-    nullsym.st_name = len(symstrtab)
-    symstrtab += b"\x00"
-    symtab.append(nullsym)
+    # With more sections than st_shndx can index, symbols in the last
+    # ones get SHN_XINDEX and their index goes to an SHT_SYMTAB_SHNDX
+    # table (.wsymtab_shndx), one 32 bit entry per symbol.
+    xindex = len(shdrs) > elf.SHN_LORESERVE
+    swap = (elff.ei_data == elf.ELFDATA2LSB) != (sys.byteorder == "little")
+
+    if spool is None:
+        symtab, strstream = io.BytesIO(), None
+        shndxtab = io.BytesIO() if xindex else None
+    else:
+        symtab = tempfile.SpooledTemporaryFile(spool)
+        strstream = None if tail_merge else tempfile.SpooledTemporaryFile(spool)
+        shndxtab = tempfile.SpooledTemporaryFile(spool) if xindex else None
+
+    symstrtab = elf.StrtabBuilder(
+        tail_merge=tail_merge, stream=strstream,
+        window=None if strstream is None else DEDUP_WINDOW)
+
+    def pack(st_name, st_value, st_size, st_shndx):
+        return sym_t.codec.pack_array(
+            len(st_value),
+            st_name=st_name,
+            st_value=st_value,
+            st_size=st_size,
+            st_info=repeat((1 << 4) | 2), # GLOBAL FUNC
+            st_other=repeat(0),
+            st_shndx=st_shndx)
+
+    symtab.write(bytes(sizeof(sym_t))) # nullsym
+    if xindex:
+        shndxtab.write(bytes(4))
+
+    # Link each symbol to the smallest section containing it.
+    indexes = section_indexes.setdefault(elff, {})
+    index = indexes.get(symbols_only)
+    if index is None:
+        index = indexes[symbols_only] = elf.SectionIndex(shdrs)
+
+    nsyms = ignored = 0
+    pending = [] # Batches waiting for tail merged offsets.
+
+    symbols = iter(symbols)
+    while True:
+        with stats.phase("parse"):
+            batch = list(islice(symbols, BATCH_SIZE))
+        if not batch:
+            break
+
+        nsyms += len(batch)
+        with stats.phase("resolve"):
+            shndxs = index.lookup_many(addr for _, addr, _ in batch)
+
+        st_name, st_value, st_size, st_shndx = columns = [], [], [], []
+
+        for (name, addr, size), shndx in zip(batch, shndxs):
+            if isinstance(name, str):
+                name = bytes(name, "utf8")
+
+            if shndx is None:
+                print("ignored (bad addr): %#x %s" % (
+                        addr, name.decode("utf8", "replace")))
+                ignored += 1
+                continue
 
-    for name, addr, size in symbols:
-        for shndx, shdr in enumerate(shdrs):
-            if shdr.sh_addr <= addr < shdr.sh_addr + shdr.sh_size:
-                break
+            if tail_merge:
+                symstrtab.add(name)
+                st_name.append(name)
+            else:
+                st_name.append(symstrtab.add(name))
+            st_value.append(addr)
+            st_size.append(size)
+            st_shndx.append(shndx)
+
+        if xindex:
+            xshndx = array("I", [shndx if shndx >= elf.SHN_LORESERVE else 0
+                                 for shndx in st_shndx])
+            if swap:
+                xshndx.byteswap()
+            shndxtab.write(xshndx.tobytes())
+            st_shndx[:] = [elf.SHN_XINDEX if shndx >= elf.SHN_LORESERVE else shndx
+                           for shndx in st_shndx]
+
+        if tail_merge:
+            pending.append(columns)
         else:
-            print("ignored (bad addr): %#x %s" % (addr, name))
-            continue
+            symtab.write(pack(*columns))
+
+    strtab = symstrtab.build()
 
-        sym = sym_t()
-        sym.st_name = len(symstrtab)
-        symstrtab += bytes(name, "utf8") + b"\x00"
-        sym.st_value = addr
-        sym.st_size = size
-        sym.st_info = (1 << 4) | 2 # GLOBAL FUNC
-        sym.st_other = 0
-        sym.st_shndx = shndx
-        symtab.append(sym)
+    for names, *columns in pending:
+        symtab.write(pack(map(symstrtab.__getitem__, names), *columns))
 
 
+    # Add symtab_shndx, before the symtab
+    chunks = []
+    if xindex:
+        shndxhdr = shdr_t()
+
+        shndxhdr.sh_type = elf.SHT_SYMTAB_SHNDX
+        shndxhdr.sh_flags = 0
+        shndxhdr.sh_addr = 0
+        shndxhdr.sh_offset = base
+        shndxhdr.sh_size = shndxtab.tell()
+        shndxhdr.sh_link = len(shdrs) + 1 # list + [us, SYMTAB]
+        shndxhdr.sh_info = 0
+        shndxhdr.sh_addralign = 1
+        shndxhdr.sh_entsize = 4
+
+        shdrs.append(shndxhdr)
+        shnames.append(b".wsymtab_shndx")
+        chunks.append(shndxtab)
+        base += shndxhdr.sh_size
+
     # Add symtab
     symtabhdr = shdr_t()
 
-    symtabhdr.sh_name = len(shstrtab)
-    shstrtab += b".wsymtab\x00"
     symtabhdr.sh_type = elf.SHT_SYMTAB
     symtabhdr.sh_flags = 0
     symtabhdr.sh_addr = 0
-    symtabhdr.sh_offset = len(elff.data)
-    symtabhdr.sh_size = len(symtab) * sizeof(sym_t)
+    symtabhdr.sh_offset = base
+    symtabhdr.sh_size = symtab.tell()
     symtabhdr.sh_link = len(shdrs) + 1 # list + [us, STRTAB]
     symtabhdr.sh_info = 0 # ?
     symtabhdr.sh_addralign = 1
     symtabhdr.sh_entsize = sizeof(sym_t)
 
     shdrs.append(symtabhdr)
+    shnames.append(b".wsymtab")
 
     # Add symstrtab
     symstrtabhdr = shdr_t()
 
-    symstrtabhdr.sh_name = len(shstrtab)
-    shstrtab += b".strtab\x00"
     symstrtabhdr.sh_type = elf.SHT_STRTAB
     symstrtabhdr.sh_flags = 0
     symstrtabhdr.sh_addr = 0
-    symstrtabhdr.sh_offset = len(elff.data) + symtabhdr.sh_size
+    symstrtabhdr.sh_offset = base + symtabhdr.sh_size
     symstrtabhdr.sh_size = len(symstrtab)
     symstrtabhdr.sh_link = 0
     symstrtabhdr.sh_info = 0
@@ -149,186 +418,776 @@ def add_symbols(elff, symbols):
     symstrtabhdr.sh_entsize = 0
 
     shdrs.append(symstrtabhdr)
+    shnames.append(b".strtab")
 
     # Add shstrtab
     shstrtabhdr = shdr_t()
 
-    shstrtabhdr.sh_name = len(shstrtab)
-    shstrtab += b".shstrtab\x00"
     shstrtabhdr.sh_type = elf.SHT_STRTAB
     shstrtabhdr.sh_flags = 0
     shstrtabhdr.sh_addr = 0
-    shstrtabhdr.sh_offset = len(elff.data) + symtabhdr.sh_size + symstrtabhdr.sh_size
-    shstrtabhdr.sh_size = len(shstrtab)
+    shstrtabhdr.sh_offset = base + symtabhdr.sh_size + symstrtabhdr.sh_size
     shstrtabhdr.sh_link = 0
     shstrtabhdr.sh_info = 0
     shstrtabhdr.sh_addralign = 1
     shstrtabhdr.sh_entsize = 0
 
     shdrs.append(shstrtabhdr)
+    shnames.append(b".shstrtab")
+
+    for name in shnames:
+        shstrtab.add(name)
+    shstrtab.build()
+
+    for shdr, name in zip(shdrs, shnames):
+        shdr.sh_name = shstrtab[name]
+    shstrtabhdr.sh_size = len(shstrtab)
+
+    # Extended numbering, what doesn't fit in the ehdr goes here.
+    if len(shdrs) >= elf.SHN_LORESERVE:
+        nullhdr.sh_size = len(shdrs)
+    if len(shdrs) - 1 >= elf.SHN_LORESERVE:
+        nullhdr.sh_link = len(shdrs) - 1
+    if elff.ehdr.e_phnum == elf.PN_XNUM:
+        nullhdr.sh_info = elff.phnum
+
+
+    # We have all the elements.
+
+    if xindex:
+        base -= shndxhdr.sh_size
+
+    tables = Tables(elff, base, chunks + [
+            symtab, strtab, shstrtab.data,
+            b"".join(map(bytes, shdrs))], len(shdrs))
+
+    tables.nsyms, tables.ignored = nsyms, ignored
+
+    return tables
+
+
+class Tables(object):
+
+    # What we append to the original data: a list of chunks written
+    # back to back at base, the last one is the section header table.
+    # Chunks are either buffers or (temporary) files.
+
+    def __init__(self, elff, base, chunks, shnum):
+        self.elff = elff
+        self.base = base
+        self.chunks = chunks
+        self.shnum = shnum
+        self.patched = 0 # Bytes written in place, before base.
+
+        self.sizes = []
+        for chunk in chunks:
+            if hasattr(chunk, "read"):
+                self.sizes.append(chunk.seek(0, os.SEEK_END))
+            else:
+                self.sizes.append(len(chunk))
+
+    @property
+    def size(self):
+        return sum(self.sizes)
+
+    def write(self, output):
+        for chunk in self.chunks:
+            if hasattr(chunk, "read"):
+                chunk.seek(0)
+                shutil.copyfileobj(chunk, output)
+            else:
+                output.write(chunk)
+
+    def ehdr(self):
+
+        ehdr = self.elff.ehdr.copy()
+
+        # Don't forget to link everythin back to ehdr:
+        ehdr.e_shoff = self.base + self.size - self.sizes[-1]
+        ehdr.e_shentsize = sizeof(self.elff.elf_shdr())
+        ehdr.e_shnum = self.shnum if self.shnum < elf.SHN_LORESERVE else 0
+        ehdr.e_shstrndx = (self.shnum - 1 if self.shnum - 1 < elf.SHN_LORESERVE
+                           else elf.SHN_XINDEX)
+
+        return ehdr
+
+
+def add_symbols(elff, symbols, tail_merge=False):
+
+    tables = build_tables(elff, symbols, tail_merge=tail_merge)
+
+    newdata = bytearray(tables.base + tables.size)
+    newdata[0:tables.base] = elff.data[0:tables.base]
+
+    tail = io.BytesIO()
+    tables.write(tail)
+    newdata[tables.base:] = tail.getbuffer()
+
+    ehdr = tables.ehdr()
+    newdata[0:sizeof(ehdr)] = ehdr
+
+    return elf.ELFFile(newdata)
+
+
+def copy_data(src, dst, start, end):
+
+    # Copy src[start:end] to dst without going through python buffers.
+    # copy_file_range lets the kernel reflink when the filesystem can,
+    # sendfile also works when dst is a pipe, plain reads otherwise.
+
+    dst.flush()
+    infd, outfd = src.fileno(), dst.fileno()
+    offset = start
+
+    for copy in (lambda n: os.copy_file_range(infd, outfd, n, offset),
+                 lambda n: os.sendfile(outfd, infd, offset, n)):
+        try:
+            while offset < end:
+                n = copy(end - offset)
+                if n == 0:
+                    break
+                offset += n
+        except (OSError, AttributeError):
+            if offset != start:
+                raise
+        else:
+            break
+
+    src.seek(offset)
+    while offset < end:
+        buf = src.read(min(end - offset, 1 << 20))
+        if not buf:
+            raise IOError("Input is too short, expected %d bytes." % end)
+        dst.write(buf)
+        offset += len(buf)
+
+
+def write_symbols(elff, symbols, output, source=None, tail_merge=False):
+
+    # Like add_symbols but streams the result to the output file,
+    # the original data is copied straight from source (if it is
+    # the file elff was read from) and never duplicated in memory.
+
+    tables = build_tables(elff, symbols, tail_merge=tail_merge,
+                          spool=SPOOL_SIZE)
+
+    with stats.phase("write"):
+        ehdr = bytes(tables.ehdr())
+        output.write(ehdr)
+
+        if source is not None:
+            copy_data(source, output, len(ehdr), tables.base)
+        else:
+            output.write(elff.data[len(ehdr):tables.base])
+
+        tables.write(output)
+
+    return tables
+
+
+def write_companion(elff, symbols, output, tail_merge=False):
+
+    # Write a file with only our symbols, for gdb's add-symbol-file:
+    # the original ehdr and phdrs (without their contents) followed by
+    # the ghosts and our tables, its size doesn't depend on the input.
+
+    tables = build_tables(elff, symbols, tail_merge=tail_merge,
+                          spool=SPOOL_SIZE, symbols_only=True)
+
+    ehdr = tables.ehdr()
+    ehdr.e_phoff = sizeof(ehdr) if ehdr.e_phnum else 0
+
+    # Segments are kept for their addresses, with no file contents,
+    # like objcopy --only-keep-debug does. PT_PHDR still has them.
+    phdrs = type(elff.phdrs).from_buffer_copy(elff.phdrs)
+    for phdr in phdrs:
+        if phdr.p_type == elf.PT_PHDR:
+            phdr.p_offset = ehdr.e_phoff
+            phdr.p_filesz = sizeof(phdrs)
+        else:
+            phdr.p_filesz = 0
+
+    with stats.phase("write"):
+        output.write(ehdr)
+        output.write(phdrs)
+        tables.write(output)
+
+    return tables
+
+
+def rewrite_symbols(elff, symbols, output, tail_merge=False):
+
+    # Symbolize the file elff was read from in place, output must be
+    # that same file opened for update. Only the tail is rewritten,
+    # replacing what a previous run added.
+
+    tables = build_tables(elff, symbols, tail_merge=tail_merge,
+                          spool=SPOOL_SIZE)
+
+    rewrite_tail(tables, output)
+
+    return tables
+
+
+def rewrite_tail(tables, output):
+
+    with stats.phase("write"):
+        output.seek(tables.base)
+        tables.write(output)
+        output.truncate()
+
+        output.seek(0)
+        output.write(tables.ehdr())
+
+
+def update_symbols(elff, symbols, output, tail_merge=False):
+
+    # Like rewrite_symbols but for a file we already symbolized:
+    # entries of symbols that are still there are left untouched,
+    # those of symbols that went away are reused for the new ones
+    # and new names are appended to the strtab. Only the patched
+    # entries and what follows the strtab are written. Falls back
+    # to rewrite_symbols when the symtab has to grow.
+
+    found = own_tables(elff)
+    if found is None or len(found) != 3: # No patching with extended numbering.
+        return rewrite_symbols(elff, symbols, output, tail_merge=tail_merge)
+
+    symtabhdr, strtabhdr, shstrtabhdr = found
+    shdrs = [shdr.copy() for shdr in elff.shdrs]
+
+    sym_t = elff.elf_sym()
+    codec = sym_t.codec
+    fields = codec.fields
+
+    # Everything we need from elff is read before writing anything,
+    # it may be a private mapping of the file we are updating.
+
+    data = elff.data
+    strtab = bytes(data[strtabhdr.sh_offset:
+                        strtabhdr.sh_offset + strtabhdr.sh_size])
+    shstrtab = bytes(data[shstrtabhdr.sh_offset:
+                          shstrtabhdr.sh_offset + shstrtabhdr.sh_size])
+
+    # Index the current entries by (name, addr, size).
+    entries = {}
+    offsets = {b"": 0}
+    free = []
+
+    nentries = symtabhdr.sh_size // codec.size
+    rows = codec.iter_unpack(data, symtabhdr.sh_offset + codec.size,
+                             nentries - 1)
+    for slot, row in enumerate(rows, 1):
+        row = dict(zip(fields, row))
+        if row["st_shndx"] == elf.SHN_UNDEF: # Cleared by a previous update.
+            free.append(slot)
+            continue
+        offset = row["st_name"]
+        name = strtab[offset:strtab.index(b"\x00", offset)]
+        offsets.setdefault(name, offset)
+        entries.setdefault((name, row["st_value"], row["st_size"]),
+                           []).append(slot)
+
+    # Diff against the new symbols.
+    index = elf.SectionIndex(elff.shdrs)
+    nsyms = ignored = 0
+    kept, added = [], []
+
+    symbols = iter(symbols)
+    while True:
+        with stats.phase("parse"):
+            batch = list(islice(symbols, BATCH_SIZE))
+        if not batch:
+            break
+
+        nsyms += len(batch)
+        with stats.phase("resolve"):
+            shndxs = index.lookup_many(addr for _, addr, _ in batch)
+
+        for (name, addr, size), shndx in zip(batch, shndxs):
+            if isinstance(name, str):
+                name = bytes(name, "utf8")
+
+            if shndx is None:
+                print("ignored (bad addr): %#x %s" % (
+                        addr, name.decode("utf8", "replace")))
+                ignored += 1
+                continue
+
+            slots = entries.get((name, addr, size))
+            if slots:
+                slots.pop()
+                kept.append((name, addr, size))
+            else:
+                added.append((name, addr, size, shndx))
+
+    free.extend(slot for slots in entries.values() for slot in slots)
+    free.sort()
+
+    if len(added) > len(free):
+        return rewrite_symbols(
+            elff, chain(kept, ((name, addr, size)
+                               for name, addr, size, _ in added)),
+            output, tail_merge=tail_merge)
+
+    # Append the names we don't have yet.
+    newnames = bytearray()
+    for name, _, _, _ in added:
+        if name not in offsets:
+            offsets[name] = strtabhdr.sh_size + len(newnames)
+            newnames += name + b"\x00"
+
+    packed = codec.pack_array(
+        len(added),
+        st_name=[offsets[name] for name, _, _, _ in added],
+        st_value=[addr for _, addr, _, _ in added],
+        st_size=[size for _, _, size, _ in added],
+        st_info=repeat((1 << 4) | 2), # GLOBAL FUNC
+        st_other=repeat(0),
+        st_shndx=[shndx for _, _, _, shndx in added])
+
+    # Move the shstrtab and section headers after the new names.
+    base = strtabhdr.sh_offset + strtabhdr.sh_size
+    shdrs[-2].sh_size += len(newnames)
+    shdrs[-1].sh_offset += len(newnames)
+
+    tables = Tables(elff, base, [
+            newnames, shstrtab, b"".join(map(bytes, shdrs))], len(shdrs))
+    tables.nsyms, tables.ignored = nsyms, ignored
+
+    # Patch the entries, those left over are cleared: undefined
+    # but still global so they don't look like misplaced locals.
+    cleared = codec.pack_array(
+        1, st_name=[0], st_value=[0], st_size=[0],
+        st_info=[1 << 4], st_other=[0], st_shndx=[elf.SHN_UNDEF])
+
+    with stats.phase("write"):
+        for i, slot in enumerate(free):
+            output.seek(symtabhdr.sh_offset + slot * codec.size)
+            if i < len(added):
+                output.write(packed[i * codec.size:(i + 1) * codec.size])
+            else:
+                output.write(cleared)
+            tables.patched += codec.size
+
+    rewrite_tail(tables, output)
+
+    return tables
+
+
+class SymbolArrays(object):
+
+    # Compact storage for (name, addr, size) symbols: addresses, sizes,
+    # names concatenated and their end offsets. Used to pass symbols
+    # between processes and to cache them on disk.
+
+    HEADER = struct.Struct("<8sQQ")
+    MAGIC = b"WSYMARR1"
+
+    def __init__(self):
+        self.addrs, self.sizes, self.ends = array("Q"), array("Q"), array("Q")
+        self.names = bytearray()
+
+    def append(self, name, addr, size):
+        self.names += name
+        self.ends.append(len(self.names))
+        self.addrs.append(addr)
+        self.sizes.append(size)
+
+    def __len__(self):
+        return len(self.addrs)
+
+    def __iter__(self):
+        names, start = bytes(self.names), 0
+        for addr, size, end in zip(self.addrs, self.sizes, self.ends):
+            yield names[start:end], addr, size
+            start = end
+
+    def tobytes(self):
+        return b"".join([
+                self.HEADER.pack(self.MAGIC, len(self), len(self.names)),
+                self.addrs.tobytes(), self.sizes.tobytes(),
+                self.ends.tobytes(), self.names])
+
+    @classmethod
+    def frombytes(cls, data):
+
+        magic, count, namesize = cls.HEADER.unpack_from(data)
+        if magic != cls.MAGIC:
+            raise ValueError("Not a symbol array.")
+
+        arrays = cls()
+        offset = cls.HEADER.size
+        for column in (arrays.addrs, arrays.sizes, arrays.ends):
+            end = offset + count * column.itemsize
+            column.frombytes(data[offset:end])
+            offset = end
+        arrays.names[:] = data[offset:offset+namesize]
+
+        if len(arrays.names) != namesize:
+            raise ValueError("Truncated symbol array.")
+
+        return arrays
+
+
+class SymbolCache(object):
+
+    # On-disk cache of what parsers return, keyed by the content of the
+    # map file and the layout of the target (IDA maps are translated
+    # using its sections). A hit costs a single read of SymbolArrays.
+
+    def __init__(self, path):
+        self.path = path
+
+    def key(self, parser, target):
+
+        data = parser.map()
+        if data is None:
+            return None
+
+        h = hashlib.sha256()
+        h.update(bytes("%s %s %r\x00" % (type(parser).__name__, sys.byteorder,
+                                          getattr(parser, "options", None)), "utf8"))
+        h.update(data)
+        h.update(bytes(target.ehdr))
+        h.update(bytes(target.phdrs))
+        h.update(bytes(target.shdrs))
+        h.update(target.shstrtab)
+
+        return h.hexdigest()
+
+    def load(self, key):
+        try:
+            with open(os.path.join(self.path, key), "rb") as f:
+                return SymbolArrays.frombytes(f.read())
+        except (OSError, ValueError, struct.error):
+            return None
+
+    def store(self, key, arrays):
+        os.makedirs(self.path, exist_ok=True)
+        with tempfile.NamedTemporaryFile(dir=self.path, delete=False) as f:
+            f.write(arrays.tobytes())
+        os.replace(f.name, os.path.join(self.path, key))
+
+    def get_symbols(self, parser, target, verbose=False, jobs=1):
+
+        key = self.key(parser, target)
+
+        cached = None if key is None else self.load(key)
+        if cached is not None:
+            yield from cached
+            return
+
+        arrays = SymbolArrays()
+        for name, addr, size in parser.get_symbols(
+                target, verbose=verbose, jobs=jobs):
+            arrays.append(name, addr, size)
+            yield name, addr, size
+
+        if key is not None:
+            self.store(key, arrays)
+
+
+class SymbolMerger(object):
+
+    # Merges symbols from several sources so that each name and each
+    # address is only given once. Sources are read by decreasing
+    # priority (then in the order they were added) and the first one
+    # to give a name or an address wins, this keeps merging a single
+    # streaming pass over two hash tables.
+
+    def __init__(self, verbose=False):
+        self.verbose = verbose
+        self.sources = []
+        self.names = {} # name -> (addr, label)
+        self.addrs = {} # addr -> (name, label)
+        self.duplicates = 0 # Same symbol given again.
+        self.conflicts = 0 # Same name or address, different symbol.
+
+    def add(self, symbols, label, priority=0):
+        self.sources.append((-priority, len(self.sources), label, symbols))
 
+    def conflict(self, what, name, addr, label, other):
+        self.conflicts += 1
+        if self.verbose:
+            print("conflict (%s): %#x %s from %s, kept %#x %s from %s" % (
+                    what, addr, name.decode("utf8", "replace"), label,
+                    other[0], other[1].decode("utf8", "replace"), other[2]))
 
-    # We have all the elements,
-    # build the new file.
+    def __iter__(self):
 
-    newdata = bytearray(len(elff.data)
-                        + symtabhdr.sh_size
-                        + symstrtabhdr.sh_size
-                        + shstrtabhdr.sh_size
-                        + sizeof(shdr_t) * len(shdrs))
+        names, addrs = self.names, self.addrs
 
-    offset = len(elff.data)
-    newdata[0:offset] = elff.data
+        for _, _, label, symbols in sorted(self.sources, key=lambda s: s[:2]):
+            for name, addr, size in symbols:
+                if isinstance(name, str):
+                    name = bytes(name, "utf8")
 
-    for sym in symtab:
-        newdata[offset:offset+sizeof(sym)] = sym
-        offset += sizeof(sym)
+                known = names.get(name)
+                if known is not None:
+                    if known[0] == addr:
+                        self.duplicates += 1
+                    else:
+                        self.conflict("name", name, addr, label,
+                                      (known[0], name, known[1]))
+                    continue
 
-    newdata[offset:offset+len(symstrtab)] = symstrtab
-    offset += len(symstrtab)
-    newdata[offset:offset+len(shstrtab)] = shstrtab
-    offset += len(shstrtab)
+                known = addrs.get(addr)
+                if known is not None:
+                    self.conflict("addr", name, addr, label,
+                                  (addr, known[0], known[1]))
+                    continue
 
-    shoff = offset
+                names[name] = addr, label
+                addrs[addr] = name, label
+                yield name, addr, size
 
-    for shdr in shdrs:
-        newdata[offset:offset+sizeof(shdr)] = shdr
-        offset += sizeof(shdr)
+        stats.count("duplicates", self.duplicates)
+        stats.count("conflicts", self.conflicts)
 
-    newelf = elf.ELFFile(newdata)
+        if self.duplicates or self.conflicts:
+            print("merged: %d duplicates and %d conflicts dropped." % (
+                    self.duplicates, self.conflicts))
 
-    # Don't forget to link everythin back to ehdr:
-    newelf.ehdr.e_shoff = shoff
-    newelf.ehdr.e_shentsize = ctypes.sizeof(shdr_t)
-    newelf.ehdr.e_shnum = len(shdrs)
-    newelf.ehdr.e_shstrndx = len(shdrs) - 1
 
-    return newelf
+def parse_range(job):
+
+    # Parallel parsing worker, see FileParser.parallel_symbols.
+
+    cls, path, start, end = job
+    with open(path, "rb") as f:
+        f.seek(start)
+        return cls.parse_chunk(f.read(end - start))
 
 
 class FileParser(object):
 
+    # Maps are parsed as bytes, no line is ever decoded and names
+    # are given as utf8 bytes. Regular files are memory mapped and
+    # scanned SCAN_SIZE at a time, others are read that much at a
+    # time. Compressed maps are decompressed on the fly.
+    SCAN_SIZE = 8 << 20
+
+    MAGICS = {
+        b"\x1f\x8b": "gzip",
+        b"\xfd7zXZ\x00": "xz",
+        b"\x28\xb5\x2f\xfd": "zstd",
+    }
+
+    # Maps bigger than this are split and parsed by several
+    # processes when the parser supports it (has a parse_lines).
+    PARALLEL_MIN = 16 << 20
+
     def __init__(self, path):
-        self.file = argparse.FileType("r")(path)
+        self.file = argparse.FileType("rb")(path)
+        self.path = path
+
+        head = self.file.peek(6)[:6]
+        self.compression = next((name for magic, name in self.MAGICS.items()
+                                 if head.startswith(magic)), None)
+        if self.compression == "zstd" and zstandard is None:
+            self.file.close()
+            raise argparse.ArgumentTypeError(
+                "%s: the zstandard module is needed for .zst maps." % path)
 
     def log(self, msg, *args, **kwargs):
         print("%s: %s" % (self.__class__.__name__, msg), *args, **kwargs)
 
+    def map(self):
+        try:
+            with open(self.path, "rb") as f:
+                return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (OSError, ValueError): # stdin, empty files...
+            return None
+
+    @classmethod
+    def split_lines(cls, data):
+        pos = 0
+        while pos < len(data):
+            end = data.find(b"\n", pos + cls.SCAN_SIZE)
+            end = len(data) if end < 0 else end + 1
+            yield from data[pos:end].splitlines()
+            pos = end
+
+    @classmethod
+    def split_stream(cls, f):
+        rest = b""
+        for data in iter(lambda: f.read(cls.SCAN_SIZE), b""):
+            data = rest + data
+            end = data.rfind(b"\n") + 1
+            yield from data[:end].splitlines()
+            rest = data[end:]
+        if rest:
+            yield rest
+
+    def decompressed(self):
+        f = self.file
+        if self.compression == "gzip":
+            return gzip.GzipFile(fileobj=f)
+        if self.compression == "xz":
+            return lzma.LZMAFile(f)
+        if self.compression == "zstd":
+            return zstandard.ZstdDecompressor().stream_reader(f)
+        return f
+
+    def lines(self):
+        data = None if self.compression else self.map()
+        if data is None:
+            return self.split_stream(self.decompressed())
+        return self.split_lines(data)
+
+    def contents(self):
+        # The whole map, mapped unless it has to be decompressed
+        # or can't be (stdin...).
+        data = None if self.compression else self.map()
+        if data is None:
+            data = self.decompressed().read()
+        return data
+
+    def can_parallelize(self, jobs):
+        try:
+            return (jobs > 1 and hasattr(self, "parse_lines")
+                    and self.compression is None
+                    and os.path.getsize(self.path) >= self.PARALLEL_MIN)
+        except OSError: # stdin...
+            return False
 
-class FlatParser(FileParser):
+    @classmethod
+    def parse_chunk(cls, data):
 
-    def get_symbols(self, target, verbose=False):
+        # Parse whole lines of bytes into SymbolArrays.
 
-        symbols = []
+        arrays = SymbolArrays()
+        for name, addr, size in cls.parse_lines(cls.split_lines(data)):
+            arrays.append(name, addr, size)
 
-        for line in self.file:
-            if line.startswith("#"):
-                continue
-            splited = line.split()
-            if len(splited) == 3:
-                addr, name, size = splited
-            elif len(splited) == 2:
-                addr, name = splited
-                size = "0"
-            else:
-                continue
+        return arrays
 
-            addr = int(addr, 16)
-            size = int(size, 16)
+    def parallel_symbols(self, jobs):
 
-            if verbose:
-                self.log("%15s = %#x,\tsize=%d" % (
-                        name, addr, size))
+        # Split the file in byte ranges on line boundaries and parse
+        # them in a pool, results are merged back in file order.
 
-            symbols.append((name, addr, size))
+        size = os.path.getsize(self.path)
 
-        return symbols
+        bounds = [0]
+        with open(self.path, "rb") as f:
+            for i in range(1, jobs):
+                f.seek(max(size * i // jobs - 1, bounds[-1]))
+                f.readline()
+                if f.tell() < size:
+                    bounds.append(f.tell())
+        bounds.append(size)
 
+        ranges = [(type(self), self.path, start, end)
+                  for start, end in zip(bounds, bounds[1:])]
 
-class NMParser(FileParser):
+        with multiprocessing.Pool(min(jobs, len(ranges))) as pool:
+            for arrays in pool.imap(parse_range, ranges):
+                yield from arrays
+
+    def get_symbols(self, target, verbose=False, jobs=1):
+
+        # Symbols are generated lazily as (name, addr, size).
+
+        if not verbose:
+            if self.can_parallelize(jobs):
+                return self.parallel_symbols(jobs)
+            return self.parse_lines(self.lines())
+
+        return self.logged(self.parse_lines(self.lines()))
 
-    def get_symbols(self, target, verbose=False):
+    def logged(self, symbols):
+        for name, addr, size in symbols:
+            self.log("%15s = %#x,\tsize=%d" % (
+                    name.decode("utf8", "replace"), addr, size))
+            yield name, addr, size
 
-        symbols = []
 
-        for line in self.file:
-            if line.startswith("#"):
+class FlatParser(FileParser):
+
+    @staticmethod
+    def parse_lines(lines):
+
+        for line in lines:
+            if line.startswith(b"#"):
                 continue
             splited = line.split()
-            if len(splited) != 3:
-                continue
+            if len(splited) == 3:
+                addr, name, size = splited
+                yield name, int(addr, 16), int(size, 16)
+            elif len(splited) == 2:
+                addr, name = splited
+                yield name, int(addr, 16), 0
 
-            name, addr = splited[2], int(splited[0], 16)
 
-            if verbose:
-                self.log("%15s = %#x,\tsize=%d" % (
-                        name, addr, 0))
+class NMParser(FileParser):
 
-            symbols.append((name, addr, 0))
+    @staticmethod
+    def parse_lines(lines):
+
+        for line in lines:
+            if line.startswith(b"#"):
+                continue
+            splited = line.split()
+            if len(splited) == 3:
+                yield splited[2], int(splited[0], 16), 0
 
-        return symbols
 
 class IDAParser(FileParser):
 
-    def get_symbols(self, target, verbose=False):
+    def get_symbols(self, target, verbose=False, jobs=1):
 
         # OK, IDA is weird, it uses section-relative addres.
         # UNLESS there are no sections, then it uses segments.
         # No way to know... Lets guess.
 
-        for line in self.file:
-            if line.split() == ["Start", "Length", "Name", "Class"]:
+        lines = iter(self.lines())
+
+        for line in lines:
+            if line.split() == [b"Start", b"Length", b"Name", b"Class"]:
                 break
 
         sections = []
-        for line in self.file:
+        for line in lines:
             splited = line.split()
             if len(splited) != 4:
                 break
 
-            start_, _, _, name = splited
-            start, _ = start_.split(":")
-            name = bytes(name, "utf8") + b"\x00"
-            sections.append([int(start, 16), name])
+            start_, _, name, _ = splited
+            start, _ = start_.split(b":")
+            sections.append((int(start, 16), name))
 
         # Ok, this is where we guess, kinda.
         # Lets check if all those sections exit,
         # otherwise we'll consider they are segments.
 
-        i = 0
-        for shndx, shdr in enumerate(target.shdrs):
-            if i == len(sections):
-                break
-            if target.shstr(shdr.sh_name) == sections[i][1]:
-                sections[i][1] = shndx
-                i += 1
+        missing = [s for s in sections if s[1] not in target.section_index]
 
-        if i == len(sections):
+        if not missing:
             translations = {}
-            for i, shndx in sections:
-                translations[i] = target.shdrs[shndx].sh_addr
+            for i, name in sections:
+                translations[i] = target.section_by_name(name).sh_addr
         else:
-            self.log("Couldnt match %s as a section. Assuming segments." % (sections[i], ))
+            self.log("Couldnt match %s as a section. Assuming segments." % (missing[0], ))
             translations = {}
             for i, _ in sections:
                 translations[i] = target.phdrs[i+1].p_vaddr
 
         # OK, done guessing.
 
-        for line in self.file:
-            if line.split() == ["Address", "Publics", "by", "Value"]:
+        for line in lines:
+            if line.split() == [b"Address", b"Publics", b"by", b"Value"]:
                 break
-        next(self.file) # burn empty line.
-
-        symbols = []
+        next(lines, None) # burn empty line.
 
-        for line in self.file:
+        for line in lines:
             splited = line.split()
             if len(splited) != 2:
                 break
 
             segment_offset, name = splited
-            segment, offset = segment_offset.split(":")
+            segment, offset = segment_offset.split(b":")
 
             segment = int(segment, 16)
             offset = int(offset, 16)
@@ -337,40 +1196,731 @@ class IDAParser(FileParser):
 
             if verbose:
                 self.log("%15s = %#x:%x + %#x = %#x,\tsize=%d" % (
-                        name, segment, translations[segment], offset, addr, 0))
+                        name.decode("utf8", "replace"), segment,
+                        translations[segment], offset, addr, 0))
 
-            symbols.append((name, addr, 0))
+            yield name, addr, 0
 
-        return symbols
 
+class BinaryParser(FileParser):
 
-if __name__ == '__main__':
+    # Compact binary symbols, as written by ida_export.py. A header,
+    # fixed size records then all the names back to back:
+    #
+    #   magic, number of records, size of the names
+    #   addr, size, name offset, name length, type (STT_*), 0
+    #
+    # Everything is little endian and addresses are virtual addresses,
+    # loading is a single mapping and no text parsing.
+
+    HEADER = struct.Struct("<8sQQ")
+    RECORD = struct.Struct("<QQIHBB")
+    MAGIC = b"WSYMBIN1"
+
+    def get_symbols(self, target, verbose=False, jobs=1):
+
+        data = self.contents()
+
+        try:
+            magic, count, namesize = self.HEADER.unpack_from(data)
+        except struct.error:
+            magic = None
+        if magic != self.MAGIC:
+            raise ValueError("%s is not a binary symbol file." % self.path)
+
+        start = self.HEADER.size
+        end = start + count * self.RECORD.size
+        names = bytes(data[end:end + namesize])
+        if len(data) < end or len(names) != namesize:
+            raise ValueError("%s is truncated." % self.path)
+
+        records = self.RECORD.iter_unpack(memoryview(data)[start:end])
+        for addr, size, offset, length, _, _ in records:
+            name = names[offset:offset + length]
+            if verbose:
+                self.log("%15s = %#x,\tsize=%d" % (
+                        name.decode("utf8", "replace"), addr, size))
+            yield name, addr, size
+
+
+class ELFParser(FileParser):
+
+    # Symbols of the SHT_SYMTAB (or SHT_DYNSYM if there is none) of
+    # another ELF file. Entries are unpacked straight from the mapped
+    # file and only once they passed the filter on st_info, which is
+    # done over the whole table at once: the st_info column is sliced
+    # out with a stride and translated to a mask.
+
+    TYPES = {"notype": elf.STT_NOTYPE, "object": elf.STT_OBJECT,
+             "func": elf.STT_FUNC, "tls": elf.STT_TLS,
+             "ifunc": elf.STT_GNU_IFUNC}
+    BINDS = {"local": elf.STB_LOCAL, "global": elf.STB_GLOBAL,
+             "weak": elf.STB_WEAK, "unique": elf.STB_GNU_UNIQUE}
+
+    options = "func,object,ifunc", "local,global,weak" # types, binds
+
+    def mask(self):
+        types, binds = ({table[name] for name in names.split(",") if name}
+                        for table, names in zip((self.TYPES, self.BINDS),
+                                                self.options))
+        return bytes(int((info >> 4) in binds and (info & 0xf) in types)
+                     for info in range(256))
+
+    def get_symbols(self, target, verbose=False, jobs=1):
+
+        data = self.contents()
+        try:
+            source = elf.ELFFile(data)
+        except ValueError:
+            raise ValueError("%s is not an ELF file." % self.path)
+
+        symtabs = [shdr for shdr in source.shdrs if shdr.sh_type == elf.SHT_SYMTAB]
+        if not symtabs:
+            symtabs = [shdr for shdr in source.shdrs
+                       if shdr.sh_type == elf.SHT_DYNSYM]
+        if not symtabs:
+            self.log("No symbol table in %s." % self.path)
+
+        sym_t = source.elf_sym()
+        unpack_from = sym_t.codec.unpack_from
+        fields = sym_t.codec.fields
+        iname, ivalue, isize, ishndx = map(fields.index, (
+                "st_name", "st_value", "st_size", "st_shndx"))
+        mask = self.mask()
+
+        for symtab in symtabs:
+            strtab = source.shdrs[symtab.sh_link]
+            strtab = bytes(data[strtab.sh_offset:strtab.sh_offset + strtab.sh_size])
+
+            entsize = symtab.sh_entsize or sizeof(sym_t)
+            count = symtab.sh_size // entsize
+            start = symtab.sh_offset + sym_t.st_info.offset
+            infos = data[start:start + count * entsize:entsize]
+
+            for i in compress(range(count), infos.translate(mask)):
+                row = unpack_from(data, symtab.sh_offset + i * entsize)
+                if row[ishndx] == elf.SHN_UNDEF:
+                    continue
+                offset = row[iname]
+                name = strtab[offset:strtab.index(b"\x00", offset)]
+                if not name:
+                    continue
+                if verbose:
+                    self.log("%15s = %#x,\tsize=%d" % (
+                            name.decode("utf8", "replace"),
+                            row[ivalue], row[isize]))
+                yield name, row[ivalue], row[isize]
+
+
+class PollWatcher(object):
+
+    # Waits for files to change, by looking at them every INTERVAL.
+
+    INTERVAL = 1
+
+    def __init__(self, paths):
+        self.paths = paths
+        self.stamps = self.stat()
+
+    def stat(self):
+        stamps = {}
+        for path in self.paths:
+            try:
+                st = os.stat(path)
+                stamps[path] = st.st_mtime_ns, st.st_size
+            except OSError: # Being replaced.
+                stamps[path] = None
+        return stamps
+
+    def changed(self):
+        stamps = self.stat()
+        if stamps == self.stamps:
+            return False
+        self.stamps = stamps
+        return True
+
+    def wait(self):
+        while not self.changed():
+            time.sleep(self.INTERVAL)
+
+
+class InotifyWatcher(PollWatcher):
+
+    # Same thing without polling. We watch the directories since
+    # editors and IDA may replace the files instead of writing them.
+
+    IN_CLOSE_WRITE = 0x008
+    IN_MOVED_TO = 0x080
+    IN_CREATE = 0x100
+    IN_CLOEXEC = 0o2000000
+
+    EVENT = struct.Struct("iIII") # wd, mask, cookie, len
+    QUIET = 0.1 # Writers are done once they stopped for this long.
+
+    def __init__(self, paths):
+        super().__init__(paths)
+
+        libc = ctypes.CDLL(None, use_errno=True)
+        try:
+            init, add = libc.inotify_init1, libc.inotify_add_watch
+        except AttributeError:
+            raise OSError("inotify is not available")
+
+        self.fd = init(self.IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1")
+
+        self.names = {}
+        mask = self.IN_CLOSE_WRITE | self.IN_MOVED_TO | self.IN_CREATE
+        for path in paths:
+            dirname, name = os.path.split(os.path.abspath(path))
+            wd = add(self.fd, os.fsencode(dirname), mask)
+            if wd < 0:
+                os.close(self.fd)
+                raise OSError(ctypes.get_errno(), "inotify_add_watch", dirname)
+            self.names.setdefault(wd, set()).add(os.fsencode(name))
+
+    def events(self):
+        data = os.read(self.fd, 64 << 10)
+        offset = 0
+        while offset < len(data):
+            wd, _, _, length = self.EVENT.unpack_from(data, offset)
+            offset += self.EVENT.size
+            yield wd, data[offset:offset + length].rstrip(b"\x00")
+            offset += length
+
+    def wait(self):
+        while True:
+            if not any(name in self.names.get(wd, ())
+                       for wd, name in self.events()):
+                continue
+            while select.select([self.fd], [], [], self.QUIET)[0]:
+                for _ in self.events():
+                    pass
+            if self.changed():
+                return
+
+
+def watcher(paths):
+    try:
+        return InotifyWatcher(paths)
+    except OSError:
+        return PollWatcher(paths)
+
+
+class SourceAction(argparse._AppendAction):
+
+    # Appends a symbol source, tagged with the current --priority.
+
+    def __call__(self, parser, namespace, values, option_string=None):
+        values.priority = namespace.priority
+        super().__call__(parser, namespace, values, option_string)
+
+
+def argparser():
 
     parser = argparse.ArgumentParser()
-    parser.add_argument("input", type=argparse.FileType("rb"))
-    parser.add_argument("output", type=argparse.FileType("wb"))
+    parser.add_argument("input", type=argparse.FileType("rb"), nargs="?")
+    parser.add_argument("output", type=argparse.FileType("wb"), nargs="?")
 
     parser.add_argument("-v", "--verbose", action="store_true")
+    parser.add_argument("-I", "--in-place", action="store_true",
+                        help="symbolize input in place, no output.")
+    parser.add_argument("-u", "--update", action="store_true",
+                        help="like --in-place but only rewrite changed symbols.")
+    parser.add_argument("-s", "--symbols-only", action="store_true",
+                        help="only write the symbols, for gdb's add-symbol-file.")
+    parser.add_argument("-m", "--tail-merge", action="store_true",
+                        help="merge strings that are a suffix of another one.")
+    parser.add_argument("-c", "--cache", action="store_true",
+                        help="cache parsed maps.")
+    parser.add_argument("--cache-dir", metavar="DIR",
+                        default=os.path.join(os.environ.get("XDG_CACHE_HOME")
+                                             or os.path.expanduser("~/.cache"),
+                                             "wsym"),
+                        help="where to cache parsed maps. (default: %(default)s)")
+    parser.add_argument("-w", "--watch", action="store_true",
+                        help="rebuild the output whenever a map changes.")
+    parser.add_argument("--stats", action="store_const", const="table",
+                        help="print time spent in each phase and counters.")
+    parser.add_argument("--stats-json", action="store_const", const="json",
+                        dest="stats", help="same as --stats, as JSON.")
+    parser.add_argument("-b", "--batch", metavar="MANIFEST",
+                        help="run every command line listed in MANIFEST.")
+    parser.add_argument("--serve", metavar="SOCKET",
+                        help="answer requests on a unix socket, see serve().")
+    parser.add_argument("--serve-cache", metavar="MB", type=int, default=1024,
+                        help="memory kept for binaries and maps when serving."
+                        " (default: %(default)s)")
+    parser.add_argument("-j", "--jobs", type=int, default=os.cpu_count(),
+                        help="number of worker processes. (default: %(default)s)")
+
+    parser.add_argument("-M", "--merge", action="store_true",
+                        help="drop duplicate names and addresses.")
+    parser.add_argument("-P", "--priority", type=int, default=0,
+                        help="priority of the following maps when merging, "
+                        "higher wins. (default: %(default)s)")
 
     parser.set_defaults(symbols=[])
     parser.add_argument("-f", "--flat", help="flat map format. (addr, name, [size])",
-                        type=FlatParser, dest="symbols", action="append")
+                        type=FlatParser, dest="symbols", action=SourceAction)
     parser.add_argument("-i", "--ida", help="IDA .map format.",
-                        type=IDAParser, dest="symbols", action="append")
+                        type=IDAParser, dest="symbols", action=SourceAction)
     parser.add_argument("-n", "--nm", help="nm format.",
-                        type=NMParser, dest="symbols", action="append")
+                        type=NMParser, dest="symbols", action=SourceAction)
+    parser.add_argument("-x", "--bin", help="binary symbols from ida_export.py.",
+                        type=BinaryParser, dest="symbols", action=SourceAction)
+    parser.add_argument("-e", "--elf", help="symbol table of an ELF file.",
+                        type=ELFParser, dest="symbols", action=SourceAction)
+    parser.add_argument("--elf-types", default=ELFParser.options[0],
+                        help="symbol types taken from ELF files, out of %s."
+                        " (default: %%(default)s)" % ",".join(ELFParser.TYPES))
+    parser.add_argument("--elf-binds", default=ELFParser.options[1],
+                        help="symbol bindings taken from ELF files, out of %s."
+                        " (default: %%(default)s)" % ",".join(ELFParser.BINDS))
+
+    return parser
+
+
+def parse_args(argv=None):
+
+    parser = argparser()
+    args = parser.parse_intermixed_args(argv)
+
+    for names, table in ((args.elf_types, ELFParser.TYPES),
+                         (args.elf_binds, ELFParser.BINDS)):
+        unknown = set(names.split(",")) - set(table) - {""}
+        if unknown:
+            parser.error("unknown symbol type or binding: %s." % ", ".join(unknown))
+
+    if args.batch is not None or args.serve is not None:
+        if args.input is not None:
+            parser.error("--batch and --serve don't take an input or output.")
+    elif args.input is None:
+        parser.error("an input is required.")
+    elif (args.in_place or args.update) == (args.output is not None):
+        parser.error("either give an output or use --in-place/--update.")
+    elif args.symbols_only and args.output is None:
+        parser.error("--symbols-only needs an output.")
+    elif args.watch and (args.output is None
+                         or args.output.name == sys.stdout.name):
+        parser.error("--watch needs an output file.")
+
+    return args
+
+
+def parse_argv(argv):
+
+    # parse_args for command lines we are given (batch jobs, service
+    # requests), argparse's message is raised as a ValueError.
+
+    with redirect_stderr(io.StringIO()) as err:
+        try:
+            return parse_args(argv)
+        except SystemExit:
+            lines = err.getvalue().strip().splitlines()
+            raise ValueError(lines[-1] if lines else "bad command line")
+
+
+def get_symbols(args, elff, cache=None):
 
-    args = parser.parse_args()
+    # All the symbols given on the command line, for elff.
 
-    elff = elf.ELFFile(bytearray(args.input.read()))
+    if cache is None and args.cache:
+        cache = SymbolCache(args.cache_dir)
 
-    symbols = []
+    sources = []
     for parser in args.symbols:
-        symbols += parser.get_symbols(elff, verbose=args.verbose)
+        if isinstance(parser, ELFParser):
+            parser.options = args.elf_types, args.elf_binds
+        if cache is not None:
+            sources.append(cache.get_symbols(
+                    parser, elff, verbose=args.verbose, jobs=args.jobs))
+        else:
+            sources.append(parser.get_symbols(
+                    elff, verbose=args.verbose, jobs=args.jobs))
+
+    if args.merge:
+        merger = SymbolMerger(verbose=args.verbose)
+        for parser, parsed in zip(args.symbols, sources):
+            merger.add(parsed, parser.path, parser.priority)
+        return iter(merger)
+
+    return chain.from_iterable(sources)
+
+
+def symbolize(args, elff=None, source=None, cache=None):
 
-    if not symbols:
+    # Returns the number of symbols we were given
+    # and the number of bytes we wrote.
+
+    stats.reset()
+
+    if elff is None:
+        with stats.phase("read"):
+            try:
+                elff = elf.ELFFile(elf.map_file(args.input))
+                source = args.input
+            except (OSError, ValueError): # pipes, empty files...
+                elff = elf.ELFFile(bytearray(args.input.read()))
+                source = None
+
+    symbols = get_symbols(args, elff, cache)
+
+    with stats.phase("parse"):
+        first = next(symbols, None)
+    if first is None:
         print("Warning: No symbols are being added. "
               "I'll still try though, even if its pointless.")
+    else:
+        symbols = chain([first], symbols)
+
+    with stats.phase("tables"):
+        if args.in_place or args.update:
+            update = update_symbols if args.update else rewrite_symbols
+            with open(args.input.name, "r+b") as output:
+                tables = update(elff, symbols, output,
+                                tail_merge=args.tail_merge)
+            written = tables.patched + tables.size
+        elif args.symbols_only:
+            tables = write_companion(elff, symbols, args.output,
+                                     tail_merge=args.tail_merge)
+            with stats.phase("write"):
+                args.output.flush()
+            written = tables.base + tables.size
+        else:
+            tables = write_symbols(elff, symbols, args.output, source=source,
+                                   tail_merge=args.tail_merge)
+            with stats.phase("write"):
+                args.output.flush()
+            written = tables.base + tables.size
+
+    stats.count("symbols in", tables.nsyms)
+    stats.count("symbols ignored", tables.ignored)
+    stats.count("bytes written", written)
+
+    return tables.nsyms, written
+
+
+def print_stats(fmt):
+    if fmt == "json":
+        print(json.dumps(stats.report()), file=sys.stderr)
+    elif fmt is not None:
+        print(stats.table(), file=sys.stderr)
+
+
+def run_job(argv):
+
+    # Batch worker, never raises: returns (argv, error, symbols, written, time).
+
+    start, args = time.perf_counter(), None
+    try:
+        args = parse_argv(argv)
+        if args.batch is not None:
+            raise ValueError("nested --batch.")
+        args.jobs = 1 # We already are in a pool.
+        nbsyms, written = symbolize(args)
+    except Exception as e:
+        return argv, str(e) or type(e).__name__, 0, 0, time.perf_counter() - start
+    finally:
+        for f in (getattr(args, "input", None), getattr(args, "output", None)):
+            if f is not None:
+                f.close()
+
+    return argv, None, nbsyms, written, time.perf_counter() - start
+
+
+def batch(manifest, jobs):
+
+    # Each line of the manifest is a regular wsym command line,
+    # relative paths are relative to the current directory.
+
+    with open(manifest) as f:
+        argvs = [shlex.split(line, comments=True) for line in f]
+    argvs = [argv for argv in argvs if argv]
+
+    start = time.perf_counter()
+    failed = nbsyms = written = 0
+
+    with multiprocessing.Pool(jobs) as pool:
+        for argv, error, n, size, elapsed in pool.imap_unordered(run_job, argvs):
+            cmdline = " ".join(map(shlex.quote, argv))
+            if error is not None:
+                failed += 1
+                print("[FAIL] %s: %s" % (cmdline, error))
+                continue
+            nbsyms += n
+            written += size
+            print("[ OK ] %s: %d symbols, %d bytes in %.2fs" % (
+                    cmdline, n, size, elapsed))
+
+    elapsed = time.perf_counter() - start
+    print("%d jobs, %d failed in %.2fs: %d symbols (%.0f/s), %.1f MB (%.1f MB/s)" % (
+            len(argvs), failed, elapsed, nbsyms, nbsyms / elapsed,
+            written / 1e6, written / 1e6 / elapsed))
+
+    return failed
+
+
+def watch(args):
+
+    # Keep the input parsed and rebuild the output each time one of
+    # the maps changes. Outputs are written next to the final one
+    # and renamed over it, readers never see a partial file.
+
+    try:
+        elff = elf.ELFFile(elf.map_file(args.input))
+    except (OSError, ValueError):
+        sys.exit("--watch needs an input file.")
+
+    output = args.output.name
+    args.output.close()
+    mode = os.stat(args.input.fileno()).st_mode & 0o777
+
+    maps = watcher([parser.path for parser in args.symbols])
+
+    fresh = True
+    while True:
+        start = time.perf_counter()
+
+        args.output = tempfile.NamedTemporaryFile(
+            dir=os.path.dirname(os.path.abspath(output)),
+            prefix=".wsym-", delete=False)
+        try:
+            # Parsers are single use, get fresh ones. A map can be
+            # missing for a moment while it is being replaced.
+            if not fresh:
+                for i, parser in enumerate(args.symbols):
+                    parser.file.close()
+                    args.symbols[i] = type(parser)(parser.path)
+                    args.symbols[i].priority = parser.priority
+            fresh = False
+            with args.output:
+                nbsyms, written = symbolize(args, elff, args.input)
+            os.chmod(args.output.name, mode)
+            os.replace(args.output.name, output)
+            print("[ OK ] %s: %d symbols, %d bytes in %.2fs" % (
+                    output, nbsyms, written, time.perf_counter() - start))
+            print_stats(args.stats)
+        except BaseException as e:
+            args.output.close()
+            os.unlink(args.output.name)
+            if not isinstance(e, Exception):
+                raise
+            # Probably a map caught mid-write, wait for the next one.
+            print("[FAIL] %s: %s" % (output, str(e) or type(e).__name__))
+
+        maps.wait()
+
+
+class LRU(object):
+
+    # Keeps the most recently used values until their total size
+    # (as given to put) goes over maxsize.
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.size = 0
+        self.entries = OrderedDict() # key -> (value, size)
+
+    def get(self, key):
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        self.entries.move_to_end(key)
+        return entry[0]
+
+    def put(self, key, value, size):
+        if key in self.entries:
+            self.size -= self.entries.pop(key)[1]
+        self.entries[key] = value, size
+        self.size += size
+        while self.size > self.maxsize and len(self.entries) > 1:
+            _, (old, oldsize) = self.entries.popitem(last=False)
+            self.size -= oldsize
+            if hasattr(old, "close"):
+                old.close()
+
+
+def file_key(path):
+    st = os.stat(path)
+    return (os.path.abspath(path), st.st_dev, st.st_ino,
+            st.st_mtime_ns, st.st_size)
+
+
+class MappedInput(object):
+
+    # A binary kept mapped and parsed between requests. Its section
+    # indexes go with it, section_indexes keeps them while elff lives.
+    # Nothing is closed on eviction, a request may still be using it.
+
+    def __init__(self, path):
+        with open(path, "rb") as f:
+            self.elff = elf.ELFFile(elf.map_file(f))
+
+
+class MemoryCache(SymbolCache):
+
+    # Same as SymbolCache but parsed maps stay in the service's LRU,
+    # keyed by the map and target files (which are never hashed).
+
+    def __init__(self, lru, target):
+        self.lru = lru
+        self.target = target
+
+    def key(self, parser, target):
+        try:
+            return ("map", type(parser).__name__,
+                    getattr(parser, "options", None),
+                    file_key(parser.path), self.target)
+        except OSError: # stdin...
+            return None
+
+    def load(self, key):
+        return self.lru.get(key)
+
+    def store(self, key, arrays):
+        self.lru.put(key, arrays, len(arrays) * 24 + len(arrays.names))
+
+
+class SymbolService(object):
+
+    # Runs wsym command lines sent on a unix socket, with the binaries
+    # and maps they use cached. One request per connection, a line of
+    # JSON:
+    #
+    #   {"argv": [...], "cwd": "/where/paths/are/relative/to"}
+    #
+    # The answer is a line of JSON, {"symbols": n, "written": n} or
+    # {"error": "..."}. With "stream": true the command line has no
+    # output, "stream": true is added to the answer and the symbolized
+    # ELF follows until the connection is closed.
+
+    def __init__(self, maxsize):
+        self.lru = LRU(maxsize)
+        self.cwd = os.getcwd() # Requests chdir to theirs, this is restored.
+
+    def mapped(self, path):
+        key = ("elf",) + file_key(path)
+        mapped = self.lru.get(key)
+        if mapped is None:
+            mapped = MappedInput(path)
+            self.lru.put(key, mapped, key[-1])
+        return mapped, key
+
+    def handle(self, request, wfile):
+
+        stream = request.get("stream")
+        argv = list(request["argv"])
+        if stream:
+            argv.append(os.devnull) # The output, replaced below.
+
+        args = output = None
+        try:
+            if request.get("cwd"):
+                os.chdir(request["cwd"])
+            args = parse_argv(argv)
+            if (args.batch is not None or args.serve is not None
+                or args.watch):
+                raise ValueError("no --batch, --serve or --watch in requests.")
+
+            # Streamed outputs are built in a temporary file first so
+            # that errors can still be answered.
+            if stream:
+                args.output.close()
+                args.output = tempfile.TemporaryFile()
+
+            mapped, key = self.mapped(args.input.name)
+            nbsyms, written = symbolize(args, mapped.elff, args.input,
+                                        cache=MemoryCache(self.lru, key))
+            if stream:
+                output, args.output = args.output, None
+        except Exception as e:
+            return {"error": str(e) or type(e).__name__}
+        finally:
+            for f in (getattr(args, "input", None), getattr(args, "output", None)):
+                if f is not None:
+                    f.close()
+            os.chdir(self.cwd)
+
+        answer = {"symbols": nbsyms, "written": written}
+        if not stream:
+            return answer
+
+        with output:
+            answer["stream"] = True
+            wfile.write(bytes(json.dumps(answer) + "\n", "utf8"))
+            output.seek(0)
+            shutil.copyfileobj(output, wfile)
+        return None
+
+
+class ServiceHandler(socketserver.StreamRequestHandler):
+
+    def handle(self):
+        try:
+            request = json.loads(self.rfile.readline())
+        except ValueError:
+            answer = {"error": "bad request"}
+        else:
+            answer = self.server.service.handle(request, self.wfile)
+        if answer is not None:
+            self.wfile.write(bytes(json.dumps(answer) + "\n", "utf8"))
+
+
+def serve(path, maxsize):
+
+    # Requests are answered one at a time, in order.
+
+    path = os.path.abspath(path) # Requests change the cwd.
+    if os.path.exists(path):
+        os.unlink(path) # Left over by a previous service.
+
+    with socketserver.UnixStreamServer(path, ServiceHandler) as server:
+        server.service = SymbolService(maxsize)
+        try:
+            server.serve_forever()
+        finally:
+            os.unlink(path)
+
+
+def request(path, argv, stream=None):
+
+    # Client side of serve(), returns the answer. With stream (a file)
+    # the output is written there instead of a file named in argv.
+
+    with socket.socket(socket.AF_UNIX) as sock:
+        sock.connect(path)
+        with sock.makefile("rwb") as f:
+            f.write(bytes(json.dumps({"argv": argv, "cwd": os.getcwd(),
+                                      "stream": stream is not None}) + "\n",
+                          "utf8"))
+            f.flush()
+            sock.shutdown(socket.SHUT_WR)
+            answer = json.loads(f.readline())
+            if stream is not None and answer.get("stream"):
+                shutil.copyfileobj(f, stream)
+    return answer
+
+
+if __name__ == '__main__':
+
+    args = parse_args()
+
+    if args.batch is not None:
+        sys.exit(1 if batch(args.batch, args.jobs) else 0)
+
+    if args.serve is not None:
+        try:
+            serve(args.serve, args.serve_cache << 20)
+        except KeyboardInterrupt:
+            sys.exit(0)
+
+    if args.watch:
+        try:
+            watch(args)
+        except KeyboardInterrupt:
+            sys.exit(0)
 
-    newelf = add_symbols(elff, symbols)
-    args.output.write(newelf.data)
+    symbolize(args)
+    print_stats(args.stats)
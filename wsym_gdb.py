@@ -0,0 +1,189 @@
+#
+# Load wsym symbols from inside gdb, without writing any file:
+#
+#   (gdb) source wsym_gdb.py
+#   (gdb) wsym-load -i app.map
+#   ... export a new map from IDA ...
+#   (gdb) wsym-reload
+#
+# The symbols are written as a --symbols-only companion ELF to a
+# memfd which is loaded with add-symbol-file through /proc/<pid>/fd.
+# The target stays parsed between reloads and nothing is rebuilt
+# if the maps didn't change.
+#
+
+import os
+import sys
+import hashlib
+import tempfile
+
+import gdb
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import elf
+import wsym
+
+
+def digest(path):
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            h.update(chunk)
+    return h.digest()
+
+
+class SymbolLoader(object):
+
+    def __init__(self):
+        self.argv = None
+        self.target = None
+        self.elff = None
+        self.stamps = {} # map path -> (mtime, size, digest)
+        self.symfile = None # The memfd gdb is reading, if any.
+
+    def parse(self, argv):
+
+        # Same options as wsym.py, the input defaults to
+        # the current program and there is no output.
+
+        parser = wsym.argparser()
+        parser.add_argument("-o", "--offset",
+                            help="passed to add-symbol-file, for PIEs.")
+        parser.set_defaults(jobs=1) # Don't fork gdb unless asked to.
+        try:
+            args = parser.parse_intermixed_args(argv)
+        except SystemExit:
+            raise gdb.GdbError("wsym: bad arguments.")
+
+        if args.output is not None:
+            args.output.close()
+            raise gdb.GdbError("wsym: no output, symbols go to gdb.")
+        if args.input is not None:
+            args.input.close()
+        if not args.symbols:
+            raise gdb.GdbError("wsym: no maps given.")
+
+        return args
+
+    def stamp(self, path, previous=None):
+
+        # Only hash files that look modified.
+
+        st = os.stat(path)
+        if previous is not None and previous[:2] == (st.st_mtime_ns, st.st_size):
+            return previous
+        return st.st_mtime_ns, st.st_size, digest(path)
+
+    def load(self, argv):
+
+        args = self.parse(argv)
+
+        target = (args.input.name if args.input is not None
+                  else gdb.current_progspace().filename)
+        if target is None:
+            raise gdb.GdbError("wsym: no program, use file or give one.")
+
+        if target != self.target:
+            with open(target, "rb") as f:
+                self.elff = elf.ELFFile(elf.map_file(f))
+            self.target = target
+
+        self.argv = argv
+        self.build(args, self.stamps_of(args))
+
+    def reload(self):
+
+        if self.argv is None:
+            raise gdb.GdbError("wsym: nothing loaded yet, use wsym-load.")
+
+        args = self.parse(self.argv)
+        stamps = self.stamps_of(args)
+
+        if ({p: s[2] for p, s in stamps.items()}
+            == {p: s[2] for p, s in self.stamps.items()}):
+            for parser in args.symbols:
+                parser.file.close()
+            self.stamps = stamps
+            print("wsym: maps didn't change.")
+            return
+
+        self.build(args, stamps)
+
+    def stamps_of(self, args):
+        return {p.path: self.stamp(p.path, self.stamps.get(p.path))
+                for p in args.symbols}
+
+    def build(self, args, stamps):
+
+        try:
+            fd = os.memfd_create("wsym")
+            symfile = os.fdopen(fd, "w+b")
+        except (AttributeError, OSError): # Old python or kernel.
+            symfile = tempfile.TemporaryFile()
+
+        try:
+            tables = wsym.write_companion(self.elff, wsym.get_symbols(args, self.elff),
+                                          symfile, tail_merge=args.tail_merge)
+            symfile.flush()
+        except Exception:
+            symfile.close()
+            raise
+        finally:
+            for parser in args.symbols:
+                parser.file.close()
+
+        self.unload()
+
+        cmd = "add-symbol-file %s" % self.path(symfile)
+        if args.offset is not None:
+            cmd += " -o %s" % args.offset
+        gdb.execute(cmd, from_tty=False)
+
+        self.symfile, self.stamps = symfile, stamps
+
+        print("wsym: %d symbols loaded (%d ignored)." % (
+                tables.nsyms - tables.ignored, tables.ignored))
+
+    def path(self, symfile):
+        return "/proc/%d/fd/%d" % (os.getpid(), symfile.fileno())
+
+    def unload(self):
+        if self.symfile is None:
+            return
+        gdb.execute("remove-symbol-file %s" % self.path(self.symfile),
+                    from_tty=False)
+        self.symfile.close()
+        self.symfile = None
+
+
+loader = SymbolLoader()
+
+
+class LoadCommand(gdb.Command):
+
+    """Load symbols from maps: wsym-load [-o OFFSET] [wsym.py options] [BINARY]
+
+The binary defaults to the current program, maps are given with
+-f/-i/-n like for wsym.py, -o is the load offset of a PIE."""
+
+    def __init__(self):
+        super().__init__("wsym-load", gdb.COMMAND_FILES, gdb.COMPLETE_FILENAME)
+
+    def invoke(self, arg, from_tty):
+        loader.load(gdb.string_to_argv(arg))
+
+
+class ReloadCommand(gdb.Command):
+
+    """Reload the symbols of the last wsym-load if its maps changed."""
+
+    def __init__(self):
+        super().__init__("wsym-reload", gdb.COMMAND_FILES)
+
+    def invoke(self, arg, from_tty):
+        loader.reload()
+
+
+LoadCommand()
+ReloadCommand()